@@ -0,0 +1,402 @@
+"""Zip writer used by `chocolate export`.
+
+Members are compressed on a thread pool (zlib releases the GIL) and written
+to the archive in order by the calling thread. Files that are already
+compressed, or that deflate would not shrink, are stored as is. The output is
+a standard zip file, with ZIP64 records when it needs them.
+"""
+
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+STORED = 0
+DEFLATED = 8
+CHUNK = 1 << 20
+# Compressed members up to this size stay in memory, bigger ones spill to disk.
+SPOOL_SIZE = 8 << 20
+# Deflate has to save at least 3% for a member to be stored compressed.
+MIN_SAVING = 0.97
+PROBE_SIZE = 65536
+# Formats that are compressed already, deflating them only burns CPU.
+STORED_SUFFIXES = {
+    ".7z", ".apk", ".avi", ".br", ".bz2", ".docx", ".egg", ".flac", ".gif",
+    ".gz", ".heic", ".jar", ".jpeg", ".jpg", ".lz4", ".lzma", ".m4a", ".mkv",
+    ".mov", ".mp3", ".mp4", ".npz", ".odt", ".ogg", ".png", ".pptx", ".rar",
+    ".tbz2", ".tgz", ".txz", ".webm", ".webp", ".whl", ".woff", ".woff2",
+    ".xlsx", ".xz", ".zip", ".zst",
+}
+
+# Sizes and offsets from this value on need ZIP64 fields.
+ZIP64_LIMIT = 0xFFFFFFFF
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+END_RECORD = struct.Struct("<IHHHHIIH")
+END_RECORD64 = struct.Struct("<IQHHIIQQQQ")
+END_LOCATOR64 = struct.Struct("<IIQI")
+
+
+class Member(NamedTuple):
+    name: str
+    method: int
+    crc: int
+    size: int
+    csize: int
+    mtime_ns: int
+    mode: int
+
+
+def dos_time(mtime_ns):
+    """Return the (time, date) MS-DOS fields of a timestamp, clamped to 1980."""
+    t = time.localtime(max(mtime_ns // 1_000_000_000, 315532800))
+    return (
+        t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2,
+        (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday,
+    )
+
+
+def compress_file(path, name, level=6):
+    """Compress one file.
+
+    Returns (Member, spooled file with the member data, sha256 of the file).
+    """
+    st = os.stat(path)
+    method = DEFLATED
+    if level == 0 or os.path.splitext(name)[1].lower() in STORED_SUFFIXES:
+        method = STORED
+    spool = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+    with open(path, "rb") as fp:
+        if method == DEFLATED and st.st_size > PROBE_SIZE:
+            # A fast pass over the head spots random or packed data cheaply.
+            head = fp.read(PROBE_SIZE)
+            if len(zlib.compress(head, 1)) >= len(head) * MIN_SAVING:
+                method = STORED
+            fp.seek(0)
+        if method == DEFLATED:
+            deflate = zlib.compressobj(level, zlib.DEFLATED, -15)
+            crc, size, digest = _read(fp, lambda chunk: spool.write(deflate.compress(chunk)))
+            spool.write(deflate.flush())
+            if spool.tell() >= size * MIN_SAVING:
+                # Incompressible, store the raw bytes instead.
+                method = STORED
+                spool.seek(0)
+                spool.truncate()
+                fp.seek(0)
+        if method == STORED:
+            crc, size, digest = _read(fp, spool.write)
+    csize = spool.tell()
+    spool.seek(0)
+    return Member(name, method, crc, size, csize, st.st_mtime_ns, st.st_mode), spool, digest
+
+
+def _read(fp, write):
+    """Feed fp to write chunk by chunk, return its (crc32, size, sha256)."""
+    crc = size = 0
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fp.read(CHUNK), b""):
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+        digest.update(chunk)
+        write(chunk)
+    return crc, size, digest.hexdigest()
+
+
+def file_digest(path):
+    with open(path, "rb") as fp:
+        return _read(fp, lambda chunk: None)[2]
+
+
+class Section:
+    """Raw data of a member of an existing archive, read from its local header.
+
+    Several sections may share fp, each read seeks to its own position.
+    """
+
+    def __init__(self, fp, header_offset, size):
+        self.fp = fp
+        self.header_offset = header_offset
+        self.offset = None
+        self.remaining = size
+
+    def read(self, n):
+        if self.offset is None:
+            # The local extra field may differ from the central one.
+            self.fp.seek(self.header_offset)
+            header = LOCAL_HEADER.unpack(self.fp.read(LOCAL_HEADER.size))
+            self.offset = self.header_offset + LOCAL_HEADER.size + header[9] + header[10]
+        n = min(n, self.remaining)
+        if n <= 0:
+            return b""
+        self.fp.seek(self.offset)
+        data = self.fp.read(n)
+        if len(data) != n:
+            raise EOFError("previous archive is truncated")
+        self.offset += n
+        self.remaining -= n
+        return data
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class Previous:
+    """Members of the last export, copied as is when their file is unchanged.
+
+    The state file records, per archive, its size and mtime and the size,
+    mtime and sha256 of every member's source file. A member is reused when
+    the file's stat still matches, or when its content hashes the same.
+    """
+
+    # Files modified this close to the export may change again within the
+    # same mtime tick, their stat is not trusted next time.
+    RACY_NS = 2_000_000_000
+
+    def __init__(self, name, state_path, level):
+        self.name = os.path.abspath(name)
+        self.state_path = state_path
+        self.level = level
+        self.fp = None
+        self.infos = {}
+        self.members = {}
+        try:
+            with open(state_path) as fp:
+                self.state = json.load(fp)
+        except (OSError, ValueError):
+            self.state = {}
+        entry = self.state.get(self.name)
+        try:
+            st = os.stat(self.name)
+        except OSError:
+            return
+        # Only trust the archive this state was written for.
+        if not entry or entry.get("level") != level or [st.st_size, st.st_mtime_ns] != entry.get("stat"):
+            return
+        import zipfile
+
+        try:
+            with zipfile.ZipFile(self.name) as archive:
+                self.infos = {info.filename: info for info in archive.infolist()}
+        except (OSError, zipfile.BadZipFile):
+            return
+        self.fp = open(self.name, "rb")
+        self.members = entry.get("members", {})
+
+    def match(self, path, arcname):
+        """Return (Member, Section, sha256) of the old member, None if path changed.
+
+        Safe to call from worker threads, the Section is only read later.
+        """
+        info = self.infos.get(arcname)
+        entry = self.members.get(arcname)
+        if not info or not entry:
+            return None
+        st = os.stat(path)
+        if st.st_size != entry[0] or info.file_size != entry[0]:
+            return None
+        if st.st_mtime_ns != entry[1] and file_digest(path) != entry[2]:
+            return None
+        member = Member(
+            arcname,
+            info.compress_type,
+            info.CRC,
+            info.file_size,
+            info.compress_size,
+            st.st_mtime_ns,
+            st.st_mode,
+        )
+        return member, Section(self.fp, info.header_offset, info.compress_size), entry[2]
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+
+    def save(self, members, started_ns):
+        try:
+            st = os.stat(self.name)
+        except OSError:
+            return
+        limit = started_ns - self.RACY_NS
+        for entry in members.values():
+            if entry[1] >= limit:
+                entry[1] = 0
+        self.state[self.name] = {
+            "level": self.level,
+            "stat": [st.st_size, st.st_mtime_ns],
+            "members": members,
+        }
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        tmp = f"{self.state_path}.tmp"
+        with open(tmp, "w") as fp:
+            json.dump(self.state, fp)
+        os.replace(tmp, self.state_path)
+
+
+class ZipWriter:
+    """Append members with precomputed CRC and sizes to a zip file."""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.entries = []
+
+    def add(self, member, data):
+        """Write member followed by its (already compressed) data file."""
+        offset = self.fp.tell()
+        name = member.name.encode()
+        flags = 0x800 if not member.name.isascii() else 0
+        zip64 = member.size >= ZIP64_LIMIT or member.csize >= ZIP64_LIMIT
+        extra = struct.pack("<HHQQ", 1, 16, member.size, member.csize) if zip64 else b""
+        time_, date = dos_time(member.mtime_ns)
+        self.fp.write(
+            LOCAL_HEADER.pack(
+                0x04034B50,
+                45 if zip64 else 20,
+                flags,
+                member.method,
+                time_,
+                date,
+                member.crc,
+                0xFFFFFFFF if zip64 else member.csize,
+                0xFFFFFFFF if zip64 else member.size,
+                len(name),
+                len(extra),
+            )
+        )
+        self.fp.write(name + extra)
+        for chunk in iter(lambda: data.read(CHUNK), b""):
+            self.fp.write(chunk)
+        self.entries.append((member, offset))
+
+    def close(self):
+        start = self.fp.tell()
+        for member, offset in self.entries:
+            name = member.name.encode()
+            fields = []
+            size, csize, header_offset = member.size, member.csize, offset
+            if size >= ZIP64_LIMIT:
+                fields.append(size)
+                size = 0xFFFFFFFF
+            if csize >= ZIP64_LIMIT:
+                fields.append(csize)
+                csize = 0xFFFFFFFF
+            if offset >= ZIP64_LIMIT:
+                fields.append(offset)
+                header_offset = 0xFFFFFFFF
+            extra = b""
+            if fields:
+                extra = struct.pack(f"<HH{len(fields)}Q", 1, 8 * len(fields), *fields)
+            time_, date = dos_time(member.mtime_ns)
+            self.fp.write(
+                CENTRAL_HEADER.pack(
+                    0x02014B50,
+                    3 << 8 | 45,  # Made by Unix, zip 4.5.
+                    45 if fields else 20,
+                    0x800 if not member.name.isascii() else 0,
+                    member.method,
+                    time_,
+                    date,
+                    member.crc,
+                    csize,
+                    size,
+                    len(name),
+                    len(extra),
+                    0,
+                    0,
+                    0,
+                    (member.mode & 0xFFFF) << 16,
+                    header_offset,
+                )
+            )
+            self.fp.write(name + extra)
+        end = self.fp.tell()
+        count, cd_size = len(self.entries), end - start
+        zip64 = count >= 0xFFFF or start >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT
+        if zip64:
+            self.fp.write(
+                END_RECORD64.pack(0x06064B50, 44, 45, 45, 0, 0, count, count, cd_size, start)
+            )
+            self.fp.write(END_LOCATOR64.pack(0x07064B50, 0, end, 1))
+        self.fp.write(
+            END_RECORD.pack(
+                0x06054B50,
+                0,
+                0,
+                0xFFFF if zip64 else count,
+                0xFFFF if zip64 else count,
+                0xFFFFFFFF if zip64 else cd_size,
+                0xFFFFFFFF if zip64 else start,
+                0,
+            )
+        )
+
+
+def write_zip(name, files, level=6, workers=None, state=None, incremental=True):
+    """Write [(path, arcname)] to the zip file name using `workers` threads.
+
+    With a state path, the member digests are recorded there and, when
+    incremental, unchanged members of the previous archive at name are
+    copied without recompressing. The archive is built next to name and
+    renamed over it once complete. Returns (members written, members reused).
+    """
+    workers = workers or os.cpu_count() or 4
+    previous = Previous(name, state, level) if state else None
+    if previous and not incremental:
+        previous.infos = {}
+    started = time.time_ns()
+    members = {}
+    reused = 0
+    tmp = f"{name}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as fp, ThreadPoolExecutor(workers) as pool:
+            writer = ZipWriter(fp)
+            pending = deque()
+
+            def write_next():
+                nonlocal reused
+                member, data, digest = pending.popleft().result()
+                reused += isinstance(data, Section)
+                with data:
+                    writer.add(member, data)
+                members[member.name] = [member.size, member.mtime_ns, digest]
+
+            for path, arcname in files:
+                # Keep a bounded window in flight so memory stays flat.
+                if len(pending) >= workers * 2:
+                    write_next()
+                pending.append(pool.submit(prepare, path, arcname, level, previous))
+            while pending:
+                write_next()
+            writer.close()
+        if previous:
+            previous.close()
+        os.replace(tmp, name)
+    except BaseException:
+        if previous:
+            previous.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    if previous:
+        previous.save(members, started)
+    return len(writer.entries), reused
+
+
+def prepare(path, arcname, level, previous=None):
+    """Return (Member, data, sha256) for one file, reusing the old member if possible."""
+    if previous and previous.fp:
+        reused = previous.match(path, arcname)
+        if reused:
+            return reused
+    return compress_file(path, arcname, level)
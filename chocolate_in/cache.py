@@ -0,0 +1,276 @@
+import csv
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows, no reflinks
+    fcntl = None
+
+# Machine-wide cache shared by every chocolate project of the current user.
+CACHE_ROOT = os.environ.get("CHOCOLATE_CACHE_DIR") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "chocolate"
+)
+MAX_SIZE_MB = 2048
+FORMAT = 3  # Bumped when the layout of an entry changes.
+BASE = ("pip", "setuptools")  # Part of every cached environment.
+FICLONE = 0x40049409  # linux/fs.h: share all extents of a file (reflink)
+
+
+def size_limit():
+    """Cache size limit in bytes, from CHOCOLATE_CACHE_MAX_MB."""
+    value = os.environ.get("CHOCOLATE_CACHE_MAX_MB")
+    if value is None:
+        return MAX_SIZE_MB * 1024 * 1024
+    try:
+        return int(value) * 1024 * 1024
+    except ValueError:
+        from rich import print
+
+        print(
+            f"Warning: CHOCOLATE_CACHE_MAX_MB={value!r} is not a number, "
+            f"using {MAX_SIZE_MB} MB."
+        )
+        return MAX_SIZE_MB * 1024 * 1024
+
+
+def requirement_name(requirement):
+    """Return the normalized distribution name of a requirement string."""
+    name = re.match(r"[A-Za-z0-9._-]*", requirement.strip()).group()
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def normalize_requirements(requirements):
+    """Return the requirements sorted, de-duplicated and with normalized names."""
+    result = set()
+    for req in requirements:
+        req = "".join(req.split())
+        name = re.match(r"[A-Za-z0-9._-]*", req).group()
+        result.add(requirement_name(name) + req[len(name) :])
+    return sorted(result)
+
+
+def env_key(python, requirements):
+    """Cache key of an environment: interpreter plus requirement set."""
+    data = json.dumps([FORMAT, python, normalize_requirements(requirements)])
+    return hashlib.sha256(data.encode()).hexdigest()[:32]
+
+
+def link_file(src, dst):
+    """Hardlink src to dst, falling back to a reflink and then to a copy."""
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), dst)
+        return
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        if fcntl is None:
+            raise OSError("reflinks are not supported")
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copystat(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def record_files(site_packages, dist_info):
+    """Yield the absolute paths of the files listed in a distribution's RECORD.
+
+    Paths are relative to site-packages, console scripts point into the bin
+    folder of the venv. Files that were removed since are skipped.
+    """
+    with open(os.path.join(dist_info, "RECORD"), encoding="utf-8", newline="") as fp:
+        for row in csv.reader(fp):
+            if row:
+                path = os.path.abspath(os.path.join(site_packages, row[0]))
+                if os.path.isfile(path):
+                    yield path
+
+
+def installed_distributions(site_packages):
+    """Map normalized names to the .dist-info folders in site_packages."""
+    dists = {}
+    for entry in os.listdir(site_packages):
+        if entry.endswith(".dist-info"):
+            name = entry[: -len(".dist-info")].rpartition("-")[0]
+            dists[requirement_name(name)] = os.path.join(site_packages, entry)
+    return dists
+
+
+def read_requires(dist_info):
+    """Return the Requires-Dist entries of a distribution."""
+    requires = []
+    with open(os.path.join(dist_info, "METADATA"), encoding="utf-8") as fp:
+        for line in fp:
+            if not line.strip():
+                break
+            if line.startswith("Requires-Dist:"):
+                requires.append(line[len("Requires-Dist:") :].strip())
+    return requires
+
+
+def resolve(site_packages, requirements):
+    """Return the .dist-info folders that requirements resolved to.
+
+    Follows Requires-Dist from the requirements (and the extras they ask
+    for), pip and setuptools are always part of the set.
+    """
+    dists = installed_distributions(site_packages)
+    resolved = {}  # name: extras asked for
+    todo = list(requirements) + list(BASE)
+    while todo:
+        requirement = todo.pop().partition(";")[0]
+        name = requirement_name(requirement)
+        match = re.search(r"\[([^\]]*)\]", requirement)
+        extras = {requirement_name(e) for e in match.group(1).split(",")} if match else set()
+        if name not in dists or (name in resolved and extras <= resolved[name]):
+            continue
+        resolved[name] = resolved.get(name, set()) | extras
+        for dep in read_requires(dists[name]):
+            asked = re.findall(r"extra\s*==\s*['\"]([^'\"]+)['\"]", dep.partition(";")[2])
+            # Dependencies of an extra only count when the extra was asked for.
+            if not asked or {requirement_name(e) for e in asked} & resolved[name]:
+                todo.append(dep)
+    return [dists[name] for name in resolved]
+
+
+def restore_script(src, dst, python):
+    """Copy a console script into a venv, pointing its shebang at python."""
+    with open(src, "rb") as fp:
+        data = fp.read()
+    if data.startswith(b"#!"):
+        # pip writes the absolute path of the venv it installed into.
+        data = b"#!" + os.fsencode(python) + data[data.find(b"\n") :]
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    with open(dst, "wb") as fp:
+        fp.write(data)
+    shutil.copymode(src, dst)
+
+
+def link_tree(src, dst):
+    """Mirror every file of src into dst with `link_file`, return the size in bytes."""
+    size = 0
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        for file in files:
+            path = os.path.join(root, file)
+            link_file(path, os.path.join(target, file))
+            size += os.lstat(path).st_size
+    return size
+
+
+class EnvCache:
+    """Content-addressed store of installed environments.
+
+    Entries live in `<root>/envs/<key>` and hold the distributions a
+    requirement set resolved to. They replace the site-packages of a venv
+    instead of reinstalling. Files are shared through hardlinks, so packages in a
+    venv must not be edited in place. The least recently used entries are
+    evicted once the cache grows over `max_size` bytes. Console scripts are
+    kept next to the tree and get the shebang of the venv they are restored
+    into.
+    """
+
+    def __init__(self, root=CACHE_ROOT, max_size=None):
+        self.root = os.path.join(root, "envs")
+        self.max_size = size_limit() if max_size is None else max_size
+
+    def _meta(self, key):
+        return os.path.join(self.root, key, "meta.json")
+
+    def restore(self, key, site_packages, bin_dir, python):
+        """Replace site_packages with a cached tree, return False on a miss.
+
+        The installed distributions and their console scripts are removed
+        first, so nothing is left over to conflict with the entry. The cached
+        console scripts are written to bin_dir with python as their
+        interpreter.
+        """
+        meta = self._meta(key)
+        if not os.path.isfile(meta):
+            return False
+        bin_dir = os.path.abspath(bin_dir)
+        for dist in installed_distributions(site_packages).values():
+            if os.path.isfile(os.path.join(dist, "RECORD")):
+                for path in record_files(site_packages, dist):
+                    if os.path.dirname(path) == bin_dir:
+                        os.unlink(path)
+        shutil.rmtree(site_packages)
+        link_tree(os.path.join(self.root, key, "site-packages"), site_packages)
+        scripts = os.path.join(self.root, key, "bin")
+        for name in os.listdir(scripts):
+            restore_script(os.path.join(scripts, name), os.path.join(bin_dir, name), python)
+        os.utime(meta)  # Mark as recently used for the LRU eviction.
+        return True
+
+    def store(self, key, site_packages, bin_dir, requirements):
+        """Save the distributions requirements resolved to under key.
+
+        Other packages of the venv are left out. Old entries are evicted
+        afterwards.
+        """
+        if os.path.isfile(self._meta(key)):
+            return
+        dists = resolve(site_packages, requirements)
+        if not all(os.path.isfile(os.path.join(dist, "RECORD")) for dist in dists):
+            return  # Without a file list the entry can't be told apart.
+        bin_dir = os.path.abspath(bin_dir)
+        site_packages = os.path.abspath(site_packages)
+        tmp = os.path.join(self.root, f".tmp-{key}-{os.getpid()}")
+        try:
+            size = 0
+            os.makedirs(os.path.join(tmp, "bin"))
+            for dist in dists:
+                for path in record_files(site_packages, dist):
+                    if os.path.dirname(path) == bin_dir:
+                        target = os.path.join(tmp, "bin", os.path.basename(path))
+                        shutil.copy2(path, target)
+                    elif path.startswith(site_packages + os.sep):
+                        target = os.path.join(
+                            tmp, "site-packages", os.path.relpath(path, site_packages)
+                        )
+                        os.makedirs(os.path.dirname(target), exist_ok=True)
+                        link_file(path, target)
+                    else:
+                        continue
+                    size += os.lstat(path).st_size
+            with open(os.path.join(tmp, "meta.json"), "w") as fp:
+                json.dump(
+                    {"requirements": requirements, "size": size, "created": time.time()},
+                    fp,
+                )
+            os.rename(tmp, os.path.join(self.root, key))
+        except OSError:
+            # Another process stored the same key first, or the disk is full.
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits max_size."""
+        entries = []
+        for key in os.listdir(self.root):
+            meta = self._meta(key)
+            try:
+                with open(meta) as fp:
+                    size = json.load(fp)["size"]
+                entries.append((os.stat(meta).st_mtime, size, key))
+            except (OSError, ValueError, KeyError):
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+            total -= size
@@ -1,36 +1,73 @@
+from contextlib import contextmanager
 from os.path import isfile
 from typing import Any
-from path import Path
+from path import Path, write_atomic
 import json
+import marshal
 import os
 from rich import print
-import zipfile
-from log import setup_logging
+from log import LazyLogger
 
 
-log = setup_logging()
+log = LazyLogger()
 
 def normalize_path(path):
     """Normalize the path to a standard format."""
     return path.rstrip("/")
 
 
-def create_zip(name, include, exclude):
-    with zipfile.ZipFile(name, "w", zipfile.ZIP_DEFLATED) as zipf:
+def create_zip(name, include, exclude, level=6, workers=None, state=None, incremental=True):
+    """Zip the include paths into name, see archive.write_zip.
+
+    exclude holds gitignore-style patterns, see ignore.py. level is the
+    deflate level (0 stores everything), workers the number of
+    compression threads (default: one per CPU). With a state file, members
+    unchanged since the last export are copied from the previous archive.
+    """
+    from archive import write_zip
+    from ignore import ExcludeMatcher
+    from timings import span
+
+    matcher = ExcludeMatcher(exclude)
+    output = os.path.abspath(name)
+    files = []
+    with span("collect files") as counts:
         for path in include:
             if not os.path.exists(path):
                 print(f"Warning: {path} does not exist.")
                 continue
-            for root, dirs, files in os.walk(path):
-                if any(excl in root for excl in exclude):
-                    dirs[:] = []
-                    continue
-                for file in files:
+            for root, names in matcher.walk(path):
+                for file in names:
                     file_path = os.path.join(root, file)
-                    zipf.write(
-                        file_path,
-                        os.path.relpath(file_path, os.path.commonpath(include)),
-                    )
+                    if os.path.abspath(file_path) == output:
+                        continue  # Don't pack the previous export into itself.
+                    arcname = os.path.relpath(file_path, os.path.commonpath(include))
+                    files.append((file_path, arcname.replace(os.sep, "/")))
+        counts["files"] = len(files)
+    with span("compress") as counts:
+        result = write_zip(name, files, level, workers, state, incremental)
+        counts.update(files=result[0], bytes=os.path.getsize(name))
+    return result
+
+
+def file_stamp(path):
+    """(mtime, size, inode) of path, changes whenever the file is rewritten."""
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def read_json(path):
+    """Return the parsed JSON file, or None when it is missing or corrupted."""
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path, data):
+    """Atomically replace the JSON file at path with data."""
+    write_atomic(path, json.dumps(data, indent=2, sort_keys=True))
 
 
 def ensure_folder(path):
@@ -52,11 +89,53 @@ def ensure_length(pkgs, mini, maxi):
 
 
 class JsonConfig:
-    def __init__(self, name: str) -> None:
+    """A JSON file loaded into self.config.
+
+    With a cache path, configs of at least CACHE_MIN bytes are also kept
+    marshalled there, so later runs skip JSON decoding while the file is
+    unchanged.
+    """
+
+    CACHE_MIN = 64 * 1024
+
+    def __init__(self, name: str, cache=None) -> None:
         self.name = name
-        self.config = ~Path(name)
-        if not isinstance(self.config, dict):
-            self.config = json.loads(self.config)
+        self.cache = cache
+        self.stamp = file_stamp(name)
+        self.config = self._load_cached()
+        if self.config is None:
+            with open(name, "rb") as fp:
+                self.config = json.load(fp)
+            self._store_cached()
+        self._saved = self.snapshot()
+        self._depth = 0
+
+    def dumps(self):
+        return json.dumps(self.config, indent=2)
+
+    def snapshot(self):
+        # Version 2 has no back-references, equal configs give equal bytes.
+        return marshal.dumps(self.config, 2)
+
+    def _load_cached(self):
+        if not self.cache or self.stamp[1] < self.CACHE_MIN:
+            return None
+        try:
+            with open(self.cache, "rb") as fp:
+                # loads() on the whole file is far faster than load(fp).
+                stamp, config = marshal.loads(fp.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        return config if tuple(stamp) == self.stamp else None
+
+    def _store_cached(self):
+        if not self.cache or self.stamp[1] < self.CACHE_MIN:
+            return
+        ensure_folder(os.path.dirname(self.cache) or ".")
+        tmp = f"{self.cache}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as fp:
+            fp.write(marshal.dumps((self.stamp, self.config)))
+        os.replace(tmp, self.cache)
 
     def __getitem__(self, items):
         if not isinstance(items, tuple):
@@ -66,8 +145,42 @@ class JsonConfig:
             value = value[i]
         return value
 
-    def commit(self):
-        Path()[self.name] = self.config
+    def commit(self, force=False):
+        """Write the config, unless a transaction is open or nothing changed.
+
+        force writes even inside a transaction, what it wrote is kept if the
+        transaction is rolled back.
+        """
+        if self._depth and not force:
+            return
+        saved = self.snapshot()
+        if saved == self._saved:
+            return
+        Path()[self.name] = self.dumps()
+        self._saved = saved
+        self.stamp = file_stamp(self.name)
+        self._store_cached()
+
+    @contextmanager
+    def transaction(self):
+        """Batch every change made inside the block into a single write.
+
+            with project.transaction():
+                project["sshHost"] = host
+                project["sshPort"] = port
+
+        If the block raises (SystemExit and KeyboardInterrupt included),
+        nothing is written and the config goes back to the last saved state.
+        """
+        self._depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.config = marshal.loads(self._saved)
+            raise
+        finally:
+            self._depth -= 1
+        self.commit()
 
     def __setitem__(self, key, value):
         log.info(f'CONFIG: Set {key} to {value}')
@@ -0,0 +1,99 @@
+"""Running sync and cmd against several SSH servers at once.
+
+Servers are configured in `sshTargets` ({name: {host, port, username,
+password}}) and can be grouped in `sshGroups` ({group: [names]}). The
+server from `sshHost`/`sshPort`/... is available as "default".
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+
+class Target(NamedTuple):
+    name: str
+    host: str
+    port: int
+    username: str
+    password: str
+
+
+def default_target(config):
+    if not all(config.get(key) for key in ("sshHost", "sshPort", "sshUsername", "sshPassword")):
+        return None
+    return Target(
+        "default", config["sshHost"], int(config["sshPort"]), config["sshUsername"], config["sshPassword"]
+    )
+
+
+def all_targets(config):
+    targets = {}
+    if default := default_target(config):
+        targets[default.name] = default
+    for name, server in config.get("sshTargets", {}).items():
+        targets[name] = Target(
+            name, server["host"], int(server["port"]), server["username"], server["password"]
+        )
+    return targets
+
+
+def resolve_targets(config, spec):
+    """Turn "web,db-group" into a list of Targets, groups expanded in order.
+
+    "all" selects every configured server. Raises KeyError on unknown names.
+    """
+    targets = all_targets(config)
+    groups = config.get("sshGroups", {})
+    selected = {}
+    for name in filter(None, (part.strip() for part in spec.split(","))):
+        if name == "all":
+            names = list(targets)
+        elif name in groups:
+            names = groups[name]
+        else:
+            names = [name]
+        for item in names:
+            if item not in targets:
+                raise KeyError(item)
+            selected[item] = targets[item]
+    return list(selected.values())
+
+
+def fan_out(targets, task, workers=4):
+    """Run task(target) for every target on at most `workers` threads.
+
+    task returns (ok, detail). Returns one result dict per target, in order,
+    with name, ok, seconds and detail (the error message if task raised).
+    """
+
+    def run(target):
+        started = time.perf_counter()
+        try:
+            ok, detail = task(target)
+        except Exception as e:
+            ok, detail = False, str(e) or type(e).__name__
+        return {
+            "name": target.name,
+            "ok": ok,
+            "seconds": time.perf_counter() - started,
+            "detail": detail,
+        }
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(targets)))) as pool:
+        return list(pool.map(run, targets))
+
+
+def summary_table(results):
+    from rich.table import Table
+
+    table = Table(title="Servers")
+    for column in ("Server", "Result", "Time", "Details"):
+        table.add_column(column)
+    for result in results:
+        table.add_row(
+            result["name"],
+            "[green]ok[/green]" if result["ok"] else "[red]failed[/red]",
+            f"{result['seconds']:.2f}s",
+            str(result["detail"] or ""),
+        )
+    return table
@@ -1,8 +1,4 @@
 import subprocess
-from rich import print
-from rich.panel import Panel
-from rich.markdown import Markdown
-from rich import box
 
 short_help = dict(
     run="Runs the app specified in .chocolate.run.main with various options for logging and testing.",
@@ -17,6 +13,7 @@ short_help = dict(
     ask_for="Manages environment variables that should be asked for during startup.",
     remove="Deletes the project configuration file (.chocolate).",
     config="Displays the current configuration of the project.",
+    imports="Lists the packages imported by the project as a requirements list.",
     version="Shows the current version of the Chocolate Project Manager.",
 )
 
@@ -0,0 +1,117 @@
+"""gitignore-style exclude patterns shared by export, sync and hash.sh.
+
+Supported syntax, matched against paths relative to the project root:
+    name        a file or folder called name, at any depth
+    dir/        folders only
+    /name       anchored to the project root, like any pattern with a "/"
+    *  ?  [a-z] [!a-z]   globs that never cross a "/"
+    **          any number of folders ("**/build", "docs/**", "a/**/b")
+Everything below an excluded folder is excluded. Negation ("!") can't be
+expressed for the grep -E fallback of hash.sh, such lines are ignored; "\\!"
+and "\\#" start a name with a literal "!" or "#".
+"""
+
+import os
+import re
+
+DEFAULT_EXCLUDES = ["venv/", "log/", "__pycache__/", ".git/", ".choco_cache/"]
+# Characters that are special in Python and POSIX extended regexes alike, the
+# compiled pattern has to work with both (hash.sh falls back to grep -E).
+SPECIAL = set(".^$*+?()[]{}|\\")
+
+
+def _escape(text):
+    return "".join("\\" + char if char in SPECIAL else char for char in text)
+
+
+def _glob(pattern):
+    """Translate one path pattern (without anchors) to a regex."""
+    out = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**/", i):
+            out.append("(.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+            continue
+        if char == "*":
+            out.append("[^/]*")
+        elif char == "?":
+            out.append("[^/]")
+        elif char == "[" and "]" in pattern[i + 2 :]:
+            end = pattern.index("]", i + 2)
+            body = pattern[i + 1 : end]
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            out.append("[" + body.replace("\\", "") + "]")
+            i = end
+        else:
+            out.append(_escape(char))
+        i += 1
+    return "".join(out)
+
+
+def translate(pattern):
+    """Return the regex for one pattern, or None for blanks and comments.
+
+    The regex matches a relative path, with a trailing "/" for folders, and
+    everything below a matching folder.
+    """
+    pattern = pattern.strip()
+    if pattern.startswith("./"):
+        pattern = pattern[2:]
+    if not pattern or pattern.startswith(("#", "!")) or pattern in ("/", "."):
+        return None
+    if pattern.startswith(("\\!", "\\#")):
+        pattern = pattern[1:]
+    dir_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+    anchored = "/" in pattern
+    body = _glob(pattern.lstrip("/"))
+    prefix = "" if anchored else "(.*/)?"
+    if dir_only:
+        return f"{prefix}{body}/.*"
+    return f"{prefix}{body}(/.*)?"
+
+
+class ExcludeMatcher:
+    """All patterns compiled into one regex.
+
+        matcher = ExcludeMatcher(project["exclude"])
+        for path in matcher.files("."):
+            ...
+    """
+
+    def __init__(self, patterns=(), defaults=True):
+        patterns = (DEFAULT_EXCLUDES if defaults else []) + list(patterns)
+        parts = [part for part in map(translate, patterns) if part]
+        self.pattern = "^(" + "|".join(parts) + ")$" if parts else "^$"
+        self.regex = re.compile(self.pattern)
+
+    def match(self, rel_path, is_dir=False):
+        rel_path = rel_path.replace(os.sep, "/")
+        if is_dir:
+            rel_path += "/"
+        return bool(self.regex.match(rel_path))
+
+    def walk(self, root=".", base=None):
+        """os.walk(root) with excluded folders pruned and excluded files dropped.
+
+        Yields (folder, file names). Patterns are matched relative to base,
+        the project root, which defaults to root.
+        """
+        for current, dirs, names in os.walk(root):
+            rel = os.path.relpath(current, root if base is None else base)
+            rel = "" if rel == "." else rel.replace(os.sep, "/") + "/"
+            dirs[:] = [d for d in dirs if not self.regex.match(f"{rel}{d}/")]
+            yield current, [name for name in names if not self.regex.match(rel + name)]
+
+    def files(self, root="."):
+        """Yield the path of every file that is not excluded."""
+        for current, names in self.walk(root):
+            for name in names:
+                yield os.path.join(current, name)
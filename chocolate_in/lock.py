@@ -0,0 +1,139 @@
+import csv
+import hashlib
+import json
+import os
+from cache import normalize_requirements, requirement_name
+
+STAMP = ".chocolate-stamp"
+
+
+def read_metadata(path):
+    """Return (name, version) from a METADATA or PKG-INFO file."""
+    name = version = None
+    with open(path, encoding="utf-8") as fp:
+        for line in fp:
+            if line.startswith("Name:"):
+                name = line[5:].strip()
+            elif line.startswith("Version:"):
+                version = line[8:].strip()
+            elif not line.strip() or (name and version):
+                break
+    return name, version
+
+
+def installed_state(site_packages):
+    """Map every installed distribution to its version and RECORD hash.
+
+    RECORD lists the hash of every installed file, hashing it fingerprints the
+    installed artifact without reading the package itself.
+    """
+    state = {}
+    for entry in os.listdir(site_packages):
+        if not entry.endswith(".dist-info"):
+            continue
+        info = os.path.join(site_packages, entry)
+        try:
+            name, version = read_metadata(os.path.join(info, "METADATA"))
+            with open(os.path.join(info, "RECORD"), "rb") as fp:
+                record = hashlib.sha256(fp.read()).hexdigest()
+        except OSError:
+            continue
+        if name:
+            state[requirement_name(name)] = {"version": version, "hash": record}
+    return state
+
+
+def top_level_modules(info):
+    """Top-level import names installed by the distribution in info.
+
+    top_level.txt is used when the distribution ships one, otherwise the
+    names are taken from the files listed in RECORD.
+    """
+    try:
+        with open(os.path.join(info, "top_level.txt"), encoding="utf-8") as fp:
+            names = {line.strip().partition("/")[0] for line in fp}
+    except OSError:
+        names = set()
+        try:
+            with open(os.path.join(info, "RECORD"), newline="", encoding="utf-8") as fp:
+                rows = list(csv.reader(fp))
+        except OSError:
+            rows = []
+        for row in rows:
+            if not row:
+                continue
+            top, sep, _ = row[0].partition("/")
+            if sep:
+                names.add(top)
+            elif top.endswith((".py", ".so", ".pyd")):
+                names.add(top.partition(".")[0])
+    return {name for name in names if name.isidentifier() and name != "__pycache__"}
+
+
+def module_index(site_packages):
+    """Map every importable top-level name to the distributions providing it."""
+    index = {}
+    for entry in os.listdir(site_packages):
+        info = os.path.join(site_packages, entry)
+        if entry.endswith(".dist-info"):
+            metadata = os.path.join(info, "METADATA")
+        elif entry.endswith(".egg-info") and os.path.isdir(info):
+            metadata = os.path.join(info, "PKG-INFO")
+        else:
+            continue
+        try:
+            name, _ = read_metadata(metadata)
+        except OSError:
+            continue
+        if name:
+            for module in top_level_modules(info):
+                index.setdefault(module, []).append(name)
+    return {module: sorted(names) for module, names in index.items()}
+
+
+def build_lock(python, requirements, state):
+    lock = {
+        "python": python,
+        "requirements": normalize_requirements(requirements),
+        "packages": state,
+    }
+    lock["hash"] = hashlib.sha256(json.dumps(lock, sort_keys=True).encode()).hexdigest()
+    return lock
+
+
+def outdated(python, requirements, lock, state):
+    """Return the requirements that have to be (re)installed to match the lock.
+
+    New or changed requirements are returned as written, locked packages that
+    are missing or installed in another version are pinned to their locked
+    version.
+    """
+    if not lock or lock.get("python") != python:
+        return list(requirements)
+    locked = set(lock["requirements"])
+    todo = [
+        req for req in requirements if normalize_requirements([req])[0] not in locked
+    ]
+    for name, pkg in lock["packages"].items():
+        if state.get(name, {}).get("version") != pkg["version"]:
+            todo.append(f"{name}=={pkg['version']}")
+    return todo
+
+
+def pinned(python, requirements, lock):
+    """Return requirements with every locked package pinned to its version.
+
+    This is the set an install resolves to, requirements missing from the
+    lock are kept as written and replace the pin of the same package.
+    """
+    if not lock or lock.get("python") != python:
+        return list(requirements)
+    locked = set(lock["requirements"])
+    new = [req for req in requirements if normalize_requirements([req])[0] not in locked]
+    names = {requirement_name(req) for req in new}
+    pins = [
+        f"{name}=={pkg['version']}"
+        for name, pkg in sorted(lock["packages"].items())
+        if requirement_name(name) not in names
+    ]
+    return pins + new
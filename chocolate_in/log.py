@@ -1,15 +1,9 @@
-from rich.logging import RichHandler
-from rich.console import Console
+import atexit
 import logging
-from logging.handlers import TimedRotatingFileHandler
 import os
+import queue
 import getpass
 import datetime
-from rich import print
-
-# Create a logs directory if it doesn't exist
-if not os.path.exists("log"):
-    os.makedirs("log")
 
 # Fetch the username of the device
 username = getpass.getuser()
@@ -27,38 +21,85 @@ class CallbackHandler(logging.Handler):
         self.callback(log_entry)
 
 
-def setup_logging(level=logging.INFO, print_callback=None):
-    # Create a custom logger
-    log_file = datetime.datetime.now().strftime("log/%y-%m-%d.log")
-    logger = logging.getLogger(__name__)
-    logger.setLevel(level)
+_listener = None
 
-    # Create a TimedRotatingFileHandler
-    file_handler = TimedRotatingFileHandler(
-        log_file, when="midnight", interval=1, backupCount=7
-    )
-    file_handler.setLevel(level)
 
-    # Create a formatter that includes the username for the file
-    file_formatter = logging.Formatter(f"%(asctime)s %(levelname)s - %(message)s")
-    file_handler.setFormatter(file_formatter)
+def get_console():
+    """The Rich console shared by log output, tables and live panels."""
+    from rich import get_console
 
-    # Add the file handler to the logger
-    logger.addHandler(file_handler)
+    return get_console()
 
-    # Register the CallbackHandler if a print callback is provided
+
+def setup_logging(level=logging.INFO, print_callback=None):
+    """Configure the chocolate logger once and return it.
+
+    Records are handed to a queue and written to the log file by a
+    background thread, so logging never waits for the disk. With a print
+    callback, records are also shown on the shared console. Later calls only
+    add the console output if it is missing.
+    """
+    global _listener
+    logger = logging.getLogger(__name__)
+    if _listener is None:
+        # Create a logs directory if it doesn't exist
+        if not os.path.exists("log"):
+            os.makedirs("log")
+
+        # Create a custom logger
+        log_file = datetime.datetime.now().strftime("log/%y-%m-%d.log")
+        logger.setLevel(level)
+        logger.propagate = False
+
+        # Create a TimedRotatingFileHandler
+        from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+        file_handler = TimedRotatingFileHandler(
+            log_file, when="midnight", interval=1, backupCount=7
+        )
+        file_handler.setLevel(level)
+
+        # Create a formatter that includes the username for the file
+        file_formatter = logging.Formatter(f"%(asctime)s %(levelname)s - %(message)s")
+        file_handler.setFormatter(file_formatter)
+
+        # The file is written by the listener thread, flushed at exit.
+        records = queue.SimpleQueue()
+        _listener = QueueListener(records, file_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+        logger.addHandler(QueueHandler(records))
+
+    # Register the console output if a print callback is provided
     if print_callback:
-        callback_handler = CallbackHandler(print_callback)
-        # Using RichHandler for enhanced terminal output
-        rich_handler = RichHandler()
-        logger.addHandler(rich_handler)
+        from rich.logging import RichHandler
+
+        if not any(isinstance(h, RichHandler) for h in logger.handlers):
+            # Using RichHandler for enhanced terminal output
+            logger.addHandler(RichHandler(console=get_console()))
 
     return logger
 
 
+class LazyLogger:
+    """Stand-in logger that runs `setup_logging` on first use.
+
+    Importing a module that logs no longer creates the `log/` folder and the
+    file handler; commands that never log never pay for it.
+    """
+
+    def __init__(self, **kwargs):
+        self._kwargs = kwargs
+        self._logger = None
+
+    def __getattr__(self, name):
+        if self._logger is None:
+            self._logger = setup_logging(**self._kwargs)
+        return getattr(self._logger, name)
+
+
 # Custom print function using Rich
 
 
 def custom_print_format(log_entry):
-    console = Console()
-    console.log(log_entry)  # Using rich to print the log entry
+    get_console().log(log_entry)  # Using rich to print the log entry
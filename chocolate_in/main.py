@@ -1,25 +1,17 @@
 import os
 import argparse
+import contextlib
 import sys
-from paramiko import sftp
-from rich.console import Console
-from rich.table import Table
-from rich.markdown import Markdown
-from rich.live import Live
-from rich.panel import Panel
-from rich.pretty import Pretty
-from log import setup_logging, custom_print_format
-from path import Path
-from config import create_zip
+from log import LazyLogger, custom_print_format, get_console
 from help import ensure_help, short_help
 import project_manager as prj
+import timings
 from project_manager import CONFIG
-from sftp import Sftp
-from template import executer, hashfind
 
-console = Console()
-path = Path()
-log = setup_logging(print_callback=custom_print_format)
+# Heavy dependencies (paramiko, rich.live, rich.markdown, ...) are imported
+# inside the handlers that need them so that short commands start fast.
+
+log = LazyLogger(print_callback=custom_print_format)
 
 
 def convert_dict_to_table(data):
@@ -32,6 +24,8 @@ def convert_dict_to_table(data):
     Returns:
         Table: A Rich Table object representing the dictionary.
     """
+    from rich.table import Table
+
     table = Table(show_header=False)
     for key, value in data.items():
         table.add_row(str(key), str(value))
@@ -51,7 +45,8 @@ def ensure_env_variables():
             log.info("Requesting input for missing environment variable: %s", key)
             result = input().strip()
             project.config["environmentVariables"][key] = result
-    project.commit()
+    # Saved right away, typed values survive a failing or interrupted run.
+    project.commit(force=True)
     log.info("Environment variables have been ensured.")
 
 
@@ -116,14 +111,16 @@ def run(args):
     if args.reinstall:
         log.info("Reinstall flag detected, proceeding with reinstallation.")
         handle_reinstall()
+    from rich.markdown import Markdown
+
     env = project["environmentVariables"]
     flags = project["flagsString"]
     venv = prj.VenvManager()
     try:
         log.info("Running the project startfile: %s.", project["mainFile"])
-        console.print(Markdown("---"))
+        get_console().print(Markdown("---"))
         venv.run(project["mainFile"], flags, env)
-        console.print(Markdown("---"))
+        get_console().print(Markdown("---"))
         log.info("Process finished.")
 
     except Exception as e:
@@ -138,26 +135,84 @@ def handle_package_installation(packages):
         packages (list): List of packages to install.
     """
     log.info("Starting the package installation process for packages: %s.", packages)
+    if not packages:
+        log.info("No packages to install.")
+        return
     project = get_project_config()
     venv = prj.VenvManager()
-    res = Panel("", title="Output")
-    with Live(res, refresh_per_second=4) as live:
-        val = ""
-        for pkg in packages:
-            try:
-                for i in venv.install(pkg):
-                    val += i + "\n"
-                    res.renderable = val
-            except Exception as err:
-                log.error("Problem while installing package %s: %s", pkg, err)
-            else:
-                log.info("Package %s installed successfully.", pkg)
-            if pkg not in project.config["requirements"]:
-                log.info("New package added: %s.", pkg)
-                project.config["requirements"].append(pkg)
+    wanted = project["requirements"] + [
+        pkg for pkg in packages if pkg not in project["requirements"]
+    ]
+    failed = []
+    failed_names = set()
+    todo = venv.outdated(wanted)
+    if not todo:
+        log.info("Environment matches %s, nothing to install.", prj.LOCK)
+    else:
+        # The lock wins over the cache: only reuse an environment with the
+        # same pinned versions.
+        failed = install_packages(venv, todo, venv.pinned(wanted))
+        # todo may pin versions (name==1.0), compare distribution names.
+        failed_names = {prj.requirement_name(pkg) for pkg in failed}
+        venv.write_lock(
+            [pkg for pkg in wanted if prj.requirement_name(pkg) not in failed_names]
+        )
+    for pkg in packages:
+        if prj.requirement_name(pkg) not in failed_names:
+            log.info("Package %s installed successfully.", pkg)
+        if pkg not in project.config["requirements"]:
+            log.info("New package added: %s.", pkg)
+            project.config["requirements"].append(pkg)
+
+    project.commit()
+    log.info(venv.cache_report())
+    if failed:
+        log.error("Failed to install: %s.", ", ".join(failed))
+    else:
+        log.info("All packages installed successfully.")
+
+
+def install_packages(venv, packages, key):
+    """
+    Install packages into the venv, streaming pip's output into a panel.
+
+    Args:
+        venv (VenvManager): The virtual environment to install into.
+        packages (list): Packages that are missing or outdated.
+        key (list): The full requirement set pinned to the lock, used as the
+            cache key.
 
-    path[CONFIG] = project.config
-    log.info("All packages installed successfully.")
+    Returns:
+        list: The packages that failed to install.
+    """
+    from output import OutputSink
+
+    with OutputSink(spill=os.path.join(prj.STATE_DIR, "output", "install.log")) as sink:
+        pending = {prj.requirement_name(pkg): pkg for pkg in packages}
+        failed = []
+        try:
+            if venv.restore_cached(key):
+                log.info("Reused a cached environment for %s.", ", ".join(key))
+            else:
+                # One pip run resolves the whole set instead of one run per package.
+                for i in venv.install_many(packages):
+                    sink.write(i)
+                    if i.startswith("Collecting "):
+                        pending.pop(prj.requirement_name(i[len("Collecting "):]), None)
+                        sink.title = f"Output ({len(packages) - len(pending)}/{len(packages)})"
+                venv.store_cached(key)
+        except Exception as err:
+            # pip installs nothing when the batch fails, retry one by one to
+            # find out which packages are to blame.
+            log.warning("Batched installation failed (%s), retrying per package.", err)
+            for pkg in packages:
+                try:
+                    for i in venv.install(pkg):
+                        sink.write(i)
+                except Exception as err:
+                    log.error("Problem while installing package %s: %s", pkg, err)
+                    failed.append(pkg)
+    return failed
 
 
 def handle_env_action(args):
@@ -179,7 +234,7 @@ def handle_env_action(args):
             for key in args.pkgs[1:]:
                 log.info("Removing key from environment: %s.", key)
                 raw_project["environmentVariables"].pop(key, None)
-            path[CONFIG] = raw_project
+            project.commit()
         elif args.pkgs[0] == "private":
             for key in args.pkgs[1:]:
                 if key in raw_project["privateEnv"]:
@@ -188,7 +243,7 @@ def handle_env_action(args):
                 else:
                     log.info("Making key private: %s.", key)
                     raw_project["privateEnv"].append(key)
-            path[CONFIG] = raw_project
+            project.commit()
         else:
             log.info("Adding environment variables.")
             for env_var in args.pkgs:
@@ -198,7 +253,7 @@ def handle_env_action(args):
                     quit(1)
                 raw_project["environmentVariables"][key] = value
                 log.info("Added/edited environment variable: %s.", key)
-            path[CONFIG] = raw_project
+            project.commit()
         log.info("All environment actions have been completed.")
     except Exception as e:
         log.critical("Error handling environment action: %s", e)
@@ -213,10 +268,10 @@ def handle_flags(args):
     """
     log.info("Handling flags update with values: %s.", args.pkgs)
     try:
-        raw_project = get_project_config().config
-        raw_project["flagsString"] = " ".join(args.pkgs)
+        project = get_project_config()
+        project.config["flagsString"] = " ".join(args.pkgs)
         log.info("Flags have been updated.")
-        path[CONFIG] = raw_project
+        project.commit()
     except Exception as e:
         log.critical("Error handling flags update: %s", e)
 
@@ -236,11 +291,11 @@ def custom_action(args):
             if args.input:
                 args.pkgs.append(open(args.input).read())
             project.config["actionsScript"][args.pkgs[1]] = args.pkgs[2]
-            path[CONFIG] = project.config
+            project.commit()
         elif args.pkgs[0] == "remove":
             log.info("Removing a custom action.")
             project.config["actionsScript"].pop(args.pkgs[1])
-            path[CONFIG] = project.config
+            project.commit()
         else:
             log.info("Executing custom actions: %s.", args.pkgs)
             for i in args.pkgs:
@@ -321,11 +376,38 @@ def handle_config(args):
     Args:
         args (argparse.Namespace): The command line arguments.
     """
-    console.print(Pretty(get_project_config().config))
+    from rich.pretty import Pretty
+
+    get_console().print(Pretty(get_project_config().config))
+
+
+def handle_imports(args):
+    """
+    List the packages the project imports.
+
+    Imports are mapped to the distributions installed in the venv (yaml is
+    PyYAML), imports that no installed package provides are listed as they
+    are. With -o the list is written to a file, one per line.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+    """
+    project = get_project_config()
+    modules = prj.third_party_imports(".", project["exclude"], args.jobs)
+    requirements, unresolved = prj.requirements_for(modules, prj.module_index())
+    if unresolved:
+        log.warning("Not installed in the venv: %s.", ", ".join(unresolved))
+    lines = [f"{name}\n" for name in sorted(requirements + unresolved, key=str.lower)]
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fp:
+            fp.writelines(lines)
+        log.info("Exported %s requirement(s) to %s.", len(lines), args.output)
+    else:
+        sys.stdout.writelines(lines)
 
 
 def handle_version(args):
-    console.print("[blue]Chocolate [/blue](4.0.2-beta)")
+    get_console().print("[blue]Chocolate [/blue](4.0.2-beta)")
 
 
 def export(args):
@@ -335,6 +417,8 @@ def export(args):
     Args:
         args (argparse.Namespace): The command line arguments.y
     """
+    from config import create_zip
+
     log.info(
         "Exporting project to %s.", args.output if args.output else "default location"
     )
@@ -342,7 +426,16 @@ def export(args):
         project = get_project_config()
         name = args.output if args.output else project["info"]["name"] + ".zip"
         make_executer()
-        create_zip(name, ".", project["exclude"])
+        count, reused = create_zip(
+            name,
+            ".",
+            project["exclude"],
+            project.config.get("exportLevel", 6) if args.level is None else args.level,
+            args.jobs,
+            os.path.join(prj.STATE_DIR, "exports.json"),
+            not args.full,
+        )
+        log.info("Exported %s file(s) to %s, %s reused from the last export.", count, name, reused)
         log.info("Export completed successfully.")
     except Exception as e:
         log.critical("Error during export: %s", e)
@@ -355,6 +448,8 @@ def handle_reinstall(*_):
 
 def handle_sandbox(args):
     """Running scripts in sandbox mode"""
+    from rich.markdown import Markdown
+
     log.info("Starting the run process as sandbox mode.")
     ensure_env_variables()
     project = get_project_config()
@@ -372,31 +467,144 @@ def handle_sandbox(args):
         quit(1)
     try:
         log.info("Running the project startfile: %s.", project["mainFile"])
-        console.print(Markdown("---"))
+        get_console().print(Markdown("---"))
         venv.run_sandbox(
             project["mainFile"], flags, env, args.pkgs[0], args.pkgs[1], args.pkgs[2]
         )
-        console.print(Markdown("---"))
+        get_console().print(Markdown("---"))
         log.info("Process finished.")
 
     except Exception as e:
         log.critical("Project execution failed. Error: %s", e)
 
 def handle_ssh(args):
+    """
+    Configure the SSH servers of the project.
+
+    `ssh <host> <port> <user> <password>` sets the default server, `ssh add
+    <name> <host> <port> <user> <password>`, `ssh remove <name>`, `ssh group
+    <group> <names...>` and `ssh list` manage the servers used with -t.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+    """
     project = get_project_config()
     vals = args.pkgs
-    if len(vals) != 4:
-        log.critical('Wrong usage. use chocolate ssh --help')
-    
-    project['sshHost'] = vals[0]
-    project['sshPort'] = int(vals[1])
-    project['sshUsername'] = vals[2]
-    project['sshPassword'] = vals[3]
-    log.info('Done.')
+    targets = project.config.setdefault("sshTargets", {})
+    groups = project.config.setdefault("sshGroups", {})
+    if vals[:1] == ["add"] and len(vals) == 6:
+        targets[vals[1]] = {
+            "host": vals[2],
+            "port": int(vals[3]),
+            "username": vals[4],
+            "password": vals[5],
+        }
+    elif vals[:1] == ["remove"] and len(vals) == 2:
+        targets.pop(vals[1], None)
+        groups.pop(vals[1], None)
+    elif vals[:1] == ["group"] and len(vals) >= 3:
+        groups[vals[1]] = vals[2:]
+    elif vals[:1] == ["list"]:
+        from fleet import all_targets
+
+        servers = {
+            name: f"{t.username}@{t.host}:{t.port}"
+            for name, t in all_targets(project.config).items()
+        }
+        servers.update({group: ", ".join(names) for group, names in groups.items()})
+        get_console().print(convert_dict_to_table(servers))
+        return
+    elif len(vals) == 4:
+        project.config["sshHost"] = vals[0]
+        project.config["sshPort"] = int(vals[1])
+        project.config["sshUsername"] = vals[2]
+        project.config["sshPassword"] = vals[3]
+    else:
+        log.critical("Wrong usage. use chocolate ssh --help")
+        quit(1)
+    project.commit()
+    log.info("Done.")
+
+
+def get_targets(args, project):
+    """
+    Return the servers selected with -t, or None when -t was not given.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+        project (JsonConfig): The project configuration.
+
+    Returns:
+        list: fleet.Target objects.
+    """
+    if not args.target:
+        return None
+    from fleet import resolve_targets
+
+    try:
+        targets = resolve_targets(project.config, args.target)
+    except KeyError as e:
+        log.critical("Unknown server or group %s, see chocolate ssh list.", e)
+        quit(1)
+    if not targets:
+        log.critical("No server selected.")
+        quit(1)
+    return targets
+
+
+def run_on_targets(project, targets, task, action):
+    """
+    Run task(client, target, write) on every server concurrently.
+
+    Output lines are prefixed with the server name and shown in one panel,
+    followed by a summary table. Exits with 1 if any server failed.
+
+    Args:
+        project (JsonConfig): The project configuration.
+        targets (list): fleet.Target objects.
+        task (callable): Returns (ok, details) for one connected server.
+        action (str): Name of the spill file under .choco_cache/output.
+    """
+    from fleet import fan_out, summary_table
+    from output import OutputSink
+    from sftp import Sftp
+
+    def run(target):
+        client = Sftp(
+            target.host,
+            target.username,
+            target.password,
+            target.port,
+            project.config.get("sshIdleTimeout", 600),
+        )
+        try:
+            return task(client, target, lambda line: sink.write(f"[{target.name}] {line}"))
+        finally:
+            client.close()
+
+    spill = os.path.join(prj.STATE_DIR, "output", f"{action}.log")
+    with OutputSink("Ssh Output", spill=spill) as sink:
+        results = fan_out(targets, run, project.config.get("sshFanout", 4))
+    get_console().print(summary_table(results))
+    if not all(result["ok"] for result in results):
+        quit(1)
 
 
 def handle_sync(args):
     project = get_project_config()
+    workers = args.jobs or project.config.get("syncWorkers", 4)
+    delta_threshold = project.config.get("syncDeltaThreshold", 8 * 1024 * 1024)
+    sync_options = (
+        workers,
+        project.config.get("syncVerify", True),
+        delta_threshold,
+        project.config.get("syncBulkThreshold", 200),
+    )
+    if targets := get_targets(args, project):
+        if args.watch:
+            log.critical("--watch works with a single server, drop -t.")
+            quit(1)
+        return sync_targets(project, targets, sync_options)
     if (
         not (ip := project["sshHost"])
         or not (username := project["sshUsername"])
@@ -405,20 +613,117 @@ def handle_sync(args):
     ):
         log.critical("SSH server details are incomplete.")
         quit(1)
+    from sftp import Sftp
+
+    make_executer()
+    client = Sftp(ip, username, password, port, project.config.get("sshIdleTimeout", 600))
+
+    def full_sync():
+        client.sync(project["info", "name"], project["exclude"], *sync_options)
+
+    full_sync()
+    if args.watch:
+        watch_project(client, project, full_sync, workers, delta_threshold, args.rerun)
+        return
+    status = run_remote(client, project["info", "name"])
+    if status:
+        quit(status)
+
+
+def sync_targets(project, targets, sync_options):
+    """
+    Sync the project to several servers and run it on each of them.
+
+    The project is hashed once and the result shared by every server.
+
+    Args:
+        project (JsonConfig): The project configuration.
+        targets (list): fleet.Target objects.
+        sync_options (tuple): workers, verify, delta and bulk thresholds.
+    """
+    from sftp import scan_local
+
+    name = project["info", "name"]
     make_executer()
-    client = Sftp(ip, username, password, port)
-    client.sync(project["info", "name"], project['exclude'])
+    local = scan_local(project["exclude"])
+
+    def deploy(client, target, write):
+        stats = client.sync(name, project["exclude"], *sync_options, local=local)
+        for line in client.run(name):
+            write(line)
+        status = client.last_exit_status
+        ok = status == 0 and not stats["failed"]
+        return ok, f"{stats['files']} file(s) uploaded, {stats['failed']} failed, exit status {status}"
+
+    log.info("Syncing to %s.", ", ".join(target.name for target in targets))
+    run_on_targets(project, targets, deploy, "sync")
+
+
+def run_remote(client, name):
+    """
+    Run run.sh on the server, streaming its output into a panel.
+
+    Args:
+        client (Sftp): The connected client.
+        name (str): The remote project folder.
+
+    Returns:
+        int: The exit status of run.sh, None if it could not be started.
+    """
+    from output import OutputSink
+
     log.info("Running...")
+    spill = os.path.join(prj.STATE_DIR, "output", "sync.log")
+    with OutputSink("Ssh Output", spill=spill) as sink:
+        for i in client.run(name):
+            sink.write(i)
+    if client.last_exit_status:
+        log.error("Remote command exited with status %s.", client.last_exit_status)
+    return client.last_exit_status
 
-    res = Panel("", title="Ssh Output")
-    with Live(res, refresh_per_second=4) as live:
-        txt = ""
-        for i in client.run(project["info"]["name"]):
-            txt += i + "\n"
-            res.renderable = txt
+
+def watch_project(client, project, full_sync, workers, delta_threshold, rerun=False):
+    """
+    Push every change of the project to the server until interrupted.
+
+    Args:
+        client (Sftp): The connected client, reused for every push.
+        project (JsonConfig): The project configuration.
+        full_sync (callable): Runs a complete sync, used when events were lost.
+        workers (int): Parallel upload channels.
+        delta_threshold (int): Minimum size for delta uploads.
+        rerun (bool): Run run.sh on the server after each pushed batch.
+    """
+    from ignore import ExcludeMatcher
+    from watch import batches, open_watcher
+
+    name = project["info", "name"]
+    watcher = open_watcher(".", ExcludeMatcher(project["exclude"]))
+    log.info("Watching for changes (%s), press Ctrl+C to stop.", type(watcher).__name__)
+    try:
+        if rerun:
+            run_remote(client, name)
+        for changed in batches(watcher):
+            if changed is None:
+                log.warning("File events were lost, running a full sync.")
+                full_sync()
+            elif not client.push(name, changed, workers, delta_threshold):
+                continue
+            if rerun:
+                run_remote(client, name)
+    except KeyboardInterrupt:
+        log.info("Stopped watching.")
+    finally:
+        watcher.close()
+        client.close()
 
 
 def make_executer():
+    import shlex
+
+    from ignore import ExcludeMatcher
+    from template import executer, hashfind
+
     project = get_project_config()
     deps = "\n".join(project["requirements"])
     env = "\n".join([f"{i}={j}" for i, j in project["environmentVariables"].items()])
@@ -432,12 +737,39 @@ def make_executer():
     with open("run.sh", "+w") as fp:
         fp.write(executer.format(project["mainFile"]))
     with open("hash.sh", "+w") as fp:
-        fp.write(hashfind)
+        matcher = ExcludeMatcher(project["exclude"])
+        fp.write(hashfind.replace("@EXCLUDE@", shlex.quote(matcher.pattern)))
     log.info("chocolate-free project is ready.")
 
 
+def remote_command(args):
+    """
+    Build the remote command from the positional words after `cmd`.
+
+    Options of chocolate itself (-t, -j, --timings, ...) are parsed out of
+    them, commands with their own options go after `--` or in quotes.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+
+    Returns:
+        str: The command to run on the server.
+    """
+    return " ".join(args.pkgs)
+
+
 def handle_cmd(args):
     project = get_project_config()
+    command = remote_command(args)
+    if targets := get_targets(args, project):
+
+        def execute(client, target, write):
+            for line in client.exec(command):
+                write(line)
+            status = client.last_exit_status
+            return status == 0, f"exit status {status}"
+
+        return run_on_targets(project, targets, execute, "cmd")
     if (
         not (ip := project["sshHost"])
         or not (username := project["sshUsername"])
@@ -446,15 +778,38 @@ def handle_cmd(args):
     ):
         log.critical("SSH server details are incomplete.")
         quit(1)
-    
-    client = Sftp(ip, username, password, port)
-    
-    res = Panel("", title="Ssh Output")
-    with Live(res, refresh_per_second=4) as live:
-        txt = ""
-        for i in client.exec(' '.join(sys.argv[2:])):
-            txt += i + "\n"
-            res.renderable = txt
+    from output import OutputSink
+    from sftp import Sftp
+
+    client = Sftp(ip, username, password, port, project.config.get("sshIdleTimeout", 600))
+
+    spill = os.path.join(prj.STATE_DIR, "output", "cmd.log")
+    with OutputSink("Ssh Output", spill=spill) as sink:
+        for i in client.exec(command):
+            sink.write(i)
+    if client.last_exit_status:
+        log.error(f"Remote command exited with status {client.last_exit_status}.")
+        quit(client.last_exit_status)
+
+
+# Actions that don't read the project config.
+NO_PROJECT = ("new", "help", "version", "remove")
+
+
+def report_timings(args):
+    """
+    Print the phase timings and write the trace requested on the command line.
+
+    Args:
+        args (argparse.Namespace): The command line arguments.
+    """
+    if not timings.enabled():
+        return
+    get_console().print(timings.summary_table())
+    if args.trace:
+        timings.write_trace(args.trace)
+        log.info("Trace written to %s.", args.trace)
+
 
 def main():
     """
@@ -471,11 +826,19 @@ def main():
     parser.add_argument("-h", "--help", action="store_true")
     parser.add_argument("-r", "--reinstall", action="store_true")
     parser.add_argument("-i", "--input", required=False)
+    parser.add_argument("-j", "--jobs", type=int, help="Parallel workers.")
+    parser.add_argument("-l", "--level", type=int, choices=range(10), help="Compression level.")
+    parser.add_argument("-t", "--target", help="Servers or groups, comma separated.")
+    parser.add_argument("--watch", action="store_true", help="Keep pushing changes.")
+    parser.add_argument("--full", action="store_true", help="Recompress every file.")
+    parser.add_argument("--rerun", action="store_true", help="Run run.sh after each push.")
+    parser.add_argument("--timings", action="store_true", help="Show the time of each phase.")
+    parser.add_argument("--trace", help="Write a Chrome trace of the phases to this file.")
     parser.add_argument(
         "pkgs", nargs="*", help="Raw input after 'add' action", default=[]
     )
 
-    args = parser.parse_args()
+    args = parser.parse_intermixed_args()
 
     actions = {
         "new": handle_new_project,
@@ -490,17 +853,27 @@ def main():
         "ask_for": handle_ask,
         "remove": handle_remove,
         "config": handle_config,
+        "imports": handle_imports,
         "version": handle_version,
         "sandbox": handle_sandbox,
         "sync": handle_sync,
         "ssh": handle_ssh,
         "cmd": handle_cmd,
-        "help": lambda x: console.print(convert_dict_to_table(short_help)),
+        "help": lambda x: get_console().print(convert_dict_to_table(short_help)),
     }
 
     if args.action in actions or args.action == "help":
         ensure_help(args)
-        actions[args.action](args)
+        if args.timings or args.trace:
+            timings.enable()
+        try:
+            with timings.span(args.action):
+                # Config changes made by the command are written once, at the end.
+                project = args.action not in NO_PROJECT and prj.get_config()
+                with project.transaction() if project else contextlib.nullcontext():
+                    actions[args.action](args)
+        finally:
+            report_timings(args)
     else:
         log.error("Unknown action requested.")
 
@@ -0,0 +1,451 @@
+"""Shared SSH connections, similar to OpenSSH's ControlMaster.
+
+A background holder process keeps one authenticated paramiko transport per
+user@host:port and password alive and listens on a local Unix socket. Every chocolate
+command attaches to it instead of doing its own TCP and SSH handshake.
+
+Each connection to the socket starts with one JSON header line and gets an
+"ok" line back:
+    {"kind": "sftp"}                 raw SFTP subsystem stream follows
+    {"kind": "exec", "cmd": "..."}   framed exec channel, see MuxChannel
+The holder exits after `idle_timeout` seconds without clients.
+"""
+
+import hashlib
+import json
+import os
+import select
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from cache import CACHE_ROOT
+
+MUX_DIR = os.path.join(CACHE_ROOT, "mux")
+CHUNK = 32768
+
+
+def socket_path(host, port, username, password):
+    # Unix socket paths are limited to ~100 bytes, hash the target. The
+    # password is part of the key so a changed (or wrong) one never reuses a
+    # connection made with another, MUX_DIR is private to the user.
+    key = json.dumps([username, host, int(port), password])
+    name = hashlib.sha256(key.encode()).hexdigest()[:24]
+    return os.path.join(MUX_DIR, f"{name}.sock")
+
+
+def _recv_exact(sock, n):
+    data = b""
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def _recv_line(sock):
+    line = b""
+    while not line.endswith(b"\n"):
+        char = sock.recv(1)
+        if not char:
+            break
+        line += char
+    return line.decode().strip()
+
+
+def _close(sock):
+    # shutdown() wakes up threads blocked in recv(), close() alone does not.
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+
+class MuxChannel:
+    """Client side of an exec channel opened by the holder.
+
+    Implements the part of paramiko's Channel used by Sftp. The holder sends
+    frames of one type byte and a 4-byte length: O (stdout), E (stderr) and
+    finally X (exit status); bytes written by the client become stdin.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._cond = threading.Condition()
+        self._out = bytearray()
+        self._err = bytearray()
+        self._closed = False
+        self._status = -1
+        threading.Thread(target=self._reader, daemon=True).start()
+
+    def _reader(self):
+        try:
+            while True:
+                head = _recv_exact(self.sock, 5)
+                if head is None:
+                    break
+                data = _recv_exact(self.sock, struct.unpack(">I", head[1:])[0])
+                if data is None:
+                    break
+                with self._cond:
+                    if head[:1] == b"O":
+                        self._out += data
+                    elif head[:1] == b"E":
+                        self._err += data
+                    elif head[:1] == b"X":
+                        self._status = struct.unpack(">i", data)[0]
+                    self._cond.notify_all()
+        except OSError:
+            pass
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+
+    def _pop(self, buffer, n):
+        with self._cond:
+            while not buffer and not self._closed:
+                self._cond.wait()
+            data = bytes(buffer[:n])
+            del buffer[:n]
+            return data
+
+    def recv(self, n):
+        return self._pop(self._out, n)
+
+    def recv_stderr(self, n):
+        return self._pop(self._err, n)
+
+    def recv_ready(self):
+        return bool(self._out)
+
+    def recv_stderr_ready(self):
+        return bool(self._err)
+
+    def exit_status_ready(self):
+        return self._closed
+
+    def recv_exit_status(self):
+        with self._cond:
+            while not self._closed:
+                self._cond.wait()
+        return self._status
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+
+    def shutdown_write(self):
+        self.sock.shutdown(socket.SHUT_WR)
+
+    def close(self):
+        self.sock.close()
+
+
+class SftpStream:
+    """Socket wrapper with the Channel methods paramiko's SFTPClient calls."""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def get_name(self):
+        return "mux"
+
+    def send(self, data):
+        return self.sock.send(data)
+
+    def recv(self, n):
+        return self.sock.recv(n)
+
+    def recv_ready(self):
+        return bool(select.select([self.sock], [], [], 0)[0])
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def gettimeout(self):
+        return self.sock.gettimeout()
+
+    def setblocking(self, blocking):
+        self.sock.setblocking(blocking)
+
+    def close(self):
+        _close(self.sock)
+
+
+class MuxClient:
+    def __init__(self, path):
+        self.path = path
+
+    def _open(self, header):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.sendall(json.dumps(header).encode() + b"\n")
+        reply = _recv_line(sock)
+        if reply != "ok":
+            sock.close()
+            raise ConnectionError(f"Shared SSH connection refused: {reply or 'closed'}")
+        return sock
+
+    def ping(self):
+        self._open({"kind": "ping"}).close()
+
+    def open_sftp(self):
+        import paramiko
+
+        return paramiko.SFTPClient(SftpStream(self._open({"kind": "sftp"})))
+
+    def exec_command(self, cmd, combine_stderr=False):
+        return MuxChannel(self._open({"kind": "exec", "cmd": cmd, "combine": combine_stderr}))
+
+
+def attach(host, port, username, password, idle_timeout=600, wait=15):
+    """Return a MuxClient for the target, starting a holder if needed.
+
+    Returns None when no shared connection can be set up, the caller should
+    then connect directly.
+    """
+    path = socket_path(host, port, username, password)
+    client = MuxClient(path)
+    try:
+        client.ping()
+        return client
+    except OSError:
+        pass
+    os.makedirs(MUX_DIR, mode=0o700, exist_ok=True)
+    try:
+        holder = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "serve", host, str(port), username, str(idle_timeout)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=MUX_DIR,
+            start_new_session=True,
+            text=True,
+        )
+        holder.stdin.write(password + "\n")
+        holder.stdin.close()
+        # The holder answers once it is authenticated and listening, or with
+        # "busy" when another holder for the target is starting or running.
+        ready = holder.stdout.readline().strip()
+        holder.stdout.close()
+    except OSError:
+        return None
+    if ready not in ("ready", "busy"):
+        return None
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        try:
+            client.ping()
+            return client
+        except OSError:
+            time.sleep(0.05)
+    return None
+
+
+class Holder:
+    def __init__(self, host, port, username, password, idle_timeout):
+        import paramiko
+
+        self.path = socket_path(host, port, username, password)
+        self.idle_timeout = idle_timeout
+        self.ssh = paramiko.SSHClient()
+        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        self.ssh.connect(host, username=username, password=password, port=port)
+        self.transport = self.ssh.get_transport()
+        self.transport.set_keepalive(30)
+        self.active = 0
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def listen(self):
+        # Only called with the holder lock held, a socket left behind belongs
+        # to a holder that is gone.
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        self.inode = os.stat(self.path).st_ino
+        server.listen(64)
+        server.settimeout(1)
+        return server
+
+    def serve(self, server):
+        try:
+            while self.transport.is_active():
+                try:
+                    client, _ = server.accept()
+                except socket.timeout:
+                    with self.lock:
+                        idle = not self.active and time.monotonic() - self.last_used > self.idle_timeout
+                    if idle:
+                        break
+                    continue
+                client.settimeout(None)
+                with self.lock:
+                    self.active += 1
+                threading.Thread(target=self._handle, args=(client,), daemon=True).start()
+        finally:
+            server.close()
+            try:
+                if os.stat(self.path).st_ino == self.inode:
+                    os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.ssh.close()
+
+    def _handle(self, client):
+        try:
+            header = json.loads(_recv_line(client) or "{}")
+            kind = header.get("kind")
+            if kind == "ping":
+                client.sendall(b"ok\n")
+            elif kind == "sftp":
+                channel = self.transport.open_session()
+                channel.invoke_subsystem("sftp")
+                client.sendall(b"ok\n")
+                self._relay(client, channel)
+            elif kind == "exec":
+                channel = self.transport.open_session()
+                channel.set_combine_stderr(bool(header.get("combine")))
+                channel.exec_command(header["cmd"])
+                client.sendall(b"ok\n")
+                self._exec(client, channel)
+            else:
+                client.sendall(b"unknown request\n")
+        except Exception as e:
+            try:
+                client.sendall(f"error {e}\n".encode())
+            except OSError:
+                pass
+        finally:
+            _close(client)
+            with self.lock:
+                self.active -= 1
+                self.last_used = time.monotonic()
+
+    def _relay(self, client, channel):
+        def upstream():
+            try:
+                for data in iter(lambda: client.recv(CHUNK), b""):
+                    channel.sendall(data)
+            except OSError:
+                pass
+            channel.close()
+
+        thread = threading.Thread(target=upstream, daemon=True)
+        thread.start()
+        try:
+            for data in iter(lambda: channel.recv(CHUNK), b""):
+                client.sendall(data)
+        except OSError:
+            pass
+        channel.close()
+        _close(client)
+        thread.join()
+
+    def _exec(self, client, channel):
+        lock = threading.Lock()
+
+        def send(kind, data):
+            with lock:
+                client.sendall(kind + struct.pack(">I", len(data)) + data)
+
+        def feed():
+            try:
+                for data in iter(lambda: client.recv(CHUNK), b""):
+                    channel.sendall(data)
+                channel.shutdown_write()
+            except OSError:
+                channel.close()  # The client went away, abort the command.
+
+        def pump_stderr():
+            try:
+                for data in iter(lambda: channel.recv_stderr(CHUNK), b""):
+                    send(b"E", data)
+            except OSError:
+                pass
+
+        threading.Thread(target=feed, daemon=True).start()
+        stderr = threading.Thread(target=pump_stderr, daemon=True)
+        stderr.start()
+        try:
+            for data in iter(lambda: channel.recv(CHUNK), b""):
+                send(b"O", data)
+            stderr.join()
+            send(b"X", struct.pack(">i", channel.recv_exit_status()))
+        except OSError:
+            pass
+        channel.close()
+
+
+def lock_holder(path):
+    """Lock path + ".lock" for the life of this process.
+
+    Returns the locked file descriptor, or None when another holder for the
+    same target already has it.
+    """
+    import fcntl
+
+    while True:
+        fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        try:
+            # The previous holder removes the file on exit, a lock on the
+            # removed file would not exclude anybody.
+            if os.stat(path + ".lock").st_ino == os.fstat(fd).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+
+def unlock_holder(path, fd):
+    """Remove the lock file taken by `lock_holder` and release it."""
+    try:
+        if os.stat(path + ".lock").st_ino == os.fstat(fd).st_ino:
+            os.unlink(path + ".lock")
+    except FileNotFoundError:
+        pass
+    os.close(fd)
+
+
+def main():
+    _, command, host, port, username, idle_timeout = sys.argv
+    password = sys.stdin.readline().rstrip("\n")
+    path = socket_path(host, port, username, password)
+    # Two commands starting at once both spawn a holder, only one may own the
+    # socket. The other tells its client to attach to the winner.
+    lock = lock_holder(path)
+    if lock is None:
+        print("busy", flush=True)
+        return 0
+    try:
+        try:
+            holder = Holder(host, int(port), username, password, float(idle_timeout))
+            server = holder.listen()
+        except Exception as e:
+            print(f"error {e}", flush=True)
+            return 1
+        print("ready", flush=True)
+        sys.stdout.close()
+        holder.serve(server)
+        return 0
+    finally:
+        unlock_holder(path, lock)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
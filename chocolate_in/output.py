@@ -0,0 +1,67 @@
+import os
+import threading
+from collections import deque
+
+
+class OutputSink:
+    """Live panel showing the tail of a command's output.
+
+    Only the last `max_lines` lines are kept in memory and the panel is
+    re-rendered by Live at most `refresh_per_second` times, so a long run
+    costs the same memory and CPU as a short one. When `spill` is a path the
+    full output is also written there.
+
+        with OutputSink("Ssh Output", spill="out.log") as sink:
+            for line in lines:
+                sink.write(line)
+    """
+
+    def __init__(self, title="Output", max_lines=500, spill=None, refresh_per_second=4):
+        self.title = title
+        self.lines = deque(maxlen=max_lines)
+        self.total = 0
+        self.spill = spill
+        self.refresh_per_second = refresh_per_second
+        self._lock = threading.Lock()
+        self._fp = None
+        self._live = None
+
+    def __enter__(self):
+        from rich.live import Live
+
+        if self.spill:
+            os.makedirs(os.path.dirname(self.spill) or ".", exist_ok=True)
+            self._fp = open(self.spill, "w", encoding="utf-8")
+        self._live = Live(self, refresh_per_second=self.refresh_per_second)
+        self._live.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._live.stop()
+        if not self._live.console.is_terminal:
+            self._live.console.line()  # Live only ends the last line on terminals.
+        if self._fp:
+            self._fp.close()
+        return False
+
+    def write(self, line):
+        with self._lock:
+            self.lines.append(line)
+            self.total += 1
+            if self._fp:
+                self._fp.write(line + "\n")
+
+    def __rich_console__(self, console, options):
+        from rich.panel import Panel
+        from rich.text import Text
+
+        # Only render what fits on screen, borders take two rows.
+        height = max(1, (options.height or console.height) - 2)
+        with self._lock:
+            visible = list(self.lines)[-height:]
+        subtitle = None
+        if self.total > len(visible):
+            subtitle = f"{self.total - len(visible)} earlier lines"
+            if self.spill:
+                subtitle += f" in {self.spill}"
+        yield Panel(Text("\n".join(visible)), title=self.title, subtitle=subtitle)
@@ -1,4 +1,5 @@
 import os
+import stat
 from os.path import isfile
 from typing import Union
 import json
@@ -10,6 +11,23 @@ def is_binary(filename):
     return mime_type is None or mime_type.startswith("application/")
 
 
+def write_atomic(path, value, mode="wt"):
+    """Write value to path, keeping its mode, without ever exposing a partial file."""
+    # Write next to the target and swap it in, a crash never leaves a
+    # half-written file behind. The pid keeps concurrent writers apart.
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, mode) as fp:
+            fp.write(value)
+        if os.path.exists(path):
+            os.chmod(tmp, stat.S_IMODE(os.stat(path).st_mode))
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
 class Path:
     def __init__(self, base: Union[None, str] = None) -> None:
         self.base = os.getcwd() if base is None else base
@@ -31,8 +49,7 @@ class Path:
         else:
             raise ValueError(f"Unsupported type: {type(value)}")
 
-        with open(path, mode) as fp:
-            fp.write(value)
+        write_atomic(path, value, mode)
 
     def __setitem__(self, name: str, value: Union[str, bytes, dict]) -> None:
         self.__setattr__(name, value)
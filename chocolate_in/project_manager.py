@@ -1,26 +1,47 @@
 import time
-from config import JsonConfig
+from config import JsonConfig, file_stamp, read_json, write_json
 from path import Path
+from cache import EnvCache, env_key, requirement_name
+import lock
+from timings import span
 import ast
 import os
+import platform
 import venv
 import sys
 import subprocess
 
 CONFIG = "chocolate.json"
-p = Path()
+LOCK = "chocolate.lock"
+STATE_DIR = ".choco_cache"  # Local caches, never synced or exported.
+CONFIG_CACHE = os.path.join(STATE_DIR, "config.marshal")
+IMPORT_CACHE = os.path.join(STATE_DIR, "imports.json")
+MODULE_INDEX = ".chocolate-modules"  # Inside the venv, next to lock.STAMP.
+PARALLEL_MIN = 64  # Fewer files are parsed faster than a process pool starts.
+_config = None  # Shared by every handler, so one transaction covers them all.
 
 
 def get_config():
-    """Receiving config from the path"""
-    if CONFIG in p:
-        return JsonConfig(CONFIG)
-    return False
+    """Receiving config from the path
+
+    The parsed config is kept for the whole process and only read again when
+    the file's mtime, size or inode changed.
+    """
+    global _config
+    try:
+        stamp = file_stamp(CONFIG)
+    except FileNotFoundError:
+        return False
+    if _config is None or (_config.stamp != stamp and not _config._depth):
+        cache = None if os.environ.get("CHOCOLATE_NO_CACHE") else CONFIG_CACHE
+        with span("config load", bytes=stamp[1]):
+            _config = JsonConfig(CONFIG, cache)
+    return _config
 
 
 def setup_project(name, start):
-    """Setting up the project"""
-    p[CONFIG] = {
+    """Setting up the project in the current directory"""
+    Path()[CONFIG] = {
         "info": {"fork": "native", "createdUnix": round(time.time()), "name": name},
         "requirements": list(),
         "startupEnv": list(),
@@ -34,15 +55,73 @@ def setup_project(name, start):
         "sshUsername": None,
         "sshPassword": None,
         "sshPort": None,
+        "sshIdleTimeout": 600,
+        "sshTargets": dict(),
+        "sshGroups": dict(),
+        "sshFanout": 4,
+        "syncWorkers": 4,
+        "syncVerify": True,
+        "syncDeltaThreshold": 8 * 1024 * 1024,
+        "syncBulkThreshold": 200,
+        "exportLevel": 6,
     }
     if not os.path.exists(start):
         with open(start, "+wt", encoding="utf-8") as fp:
             fp.write('print("Hello, Chocolate!")')
 
 
+def site_packages_dir(venv_dir):
+    if os.name == "nt":
+        return os.path.join(venv_dir, "Lib", "site-packages")
+    lib = os.path.join(venv_dir, "lib")
+    for name in sorted(os.listdir(lib)):
+        if name.startswith("python"):
+            return os.path.join(lib, name, "site-packages")
+    raise FileNotFoundError(f"No site-packages found in {venv_dir}")
+
+
+def module_index(venv_dir="venv"):
+    """Map import names to the distributions installed in venv_dir.
+
+    The index is kept in the venv and only rebuilt when site-packages
+    changed, installing or removing a package changes its mtime.
+    """
+    try:
+        site_packages = site_packages_dir(venv_dir)
+        mtime = os.stat(site_packages).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    path = os.path.join(venv_dir, MODULE_INDEX)
+    cached = read_json(path)
+    if cached and cached.get("mtime") == mtime:
+        return cached["modules"]
+    with span("module index"):
+        modules = lock.module_index(site_packages)
+    write_json(path, {"mtime": mtime, "modules": modules})
+    return modules
+
+
+def requirements_for(modules, index):
+    """Return the distributions providing modules, and the modules not found."""
+    requirements = set()
+    unresolved = []
+    for module in modules:
+        if module in index:
+            requirements.update(index[module])
+        else:
+            unresolved.append(module)
+    return sorted(requirements, key=str.lower), unresolved
+
+
 class VenvManager:
-    def __init__(self, venv_dir="venv"):
+    def __init__(self, venv_dir="venv", cache=None):
         self.venv_dir = venv_dir
+        # Shared environment cache, disabled with CHOCOLATE_NO_CACHE=1.
+        if cache is None and not os.environ.get("CHOCOLATE_NO_CACHE"):
+            cache = EnvCache()
+        self.cache = cache
+        self.cache_hits = 0
+        self.cache_misses = 0
         self.venv_python = (
             os.path.join(venv_dir, "bin", "python")
             if os.name != "nt"
@@ -52,42 +131,157 @@ class VenvManager:
         # Create the virtual environment if it doesn't exist
         if not os.path.exists(venv_dir):
             print(f"Creating virtual environment at {venv_dir}...")
-            venv.create(venv_dir, with_pip=True)
+            with span("venv create"):
+                venv.create(venv_dir, with_pip=True)
 
-    def install(self, package_name):
-        process = subprocess.Popen(
-            [self.venv_python, "-u", "-m", "pip", "install", package_name],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,  # Line buffered
+    @property
+    def site_packages(self):
+        return site_packages_dir(self.venv_dir)
+
+    @property
+    def bin_dir(self):
+        return os.path.dirname(self.venv_python)
+
+    @property
+    def python_tag(self):
+        """Interpreter identity of the venv, read from pyvenv.cfg."""
+        cfg = {}
+        with open(os.path.join(self.venv_dir, "pyvenv.cfg")) as fp:
+            for line in fp:
+                key, _, value = line.partition("=")
+                cfg[key.strip()] = value.strip()
+        version = cfg.get("version_info") or cfg.get("version", "")
+        return f"{sys.implementation.name}-{version}-{sys.platform}-{platform.machine()}"
+
+    def restore_cached(self, requirements):
+        """Link a cached environment for requirements into the venv.
+
+        Returns True on a cache hit, in which case nothing has to be installed.
+        """
+        if self.cache is None:
+            return False
+        with span("env cache restore"):
+            restored = self.cache.restore(
+                env_key(self.python_tag, requirements),
+                self.site_packages,
+                self.bin_dir,
+                os.path.abspath(self.venv_python),
+            )
+        if restored:
+            self.cache_hits += 1
+            return True
+        self.cache_misses += 1
+        return False
+
+    def store_cached(self, requirements):
+        """Save the current site-packages as the environment for requirements."""
+        if self.cache is not None:
+            with span("env cache store"):
+                self.cache.store(
+                    env_key(self.python_tag, requirements),
+                    self.site_packages,
+                    self.bin_dir,
+                    requirements,
+                )
+
+    def cache_report(self):
+        return f"Environment cache: {self.cache_hits} hit(s), {self.cache_misses} miss(es)."
+
+    def outdated(self, requirements, lock_file=LOCK):
+        """Return what has to be installed for the venv to match the lock file.
+
+        A stamp in the venv remembers the lock it was last synced with, so an
+        unchanged environment is recognized without scanning site-packages.
+        """
+        with span("lock check"):
+            current = read_json(lock_file)
+            stamp = read_json(os.path.join(self.venv_dir, lock.STAMP))
+            mtime = os.stat(self.site_packages).st_mtime_ns
+            if (
+                current
+                and stamp == {"lock": current["hash"], "mtime": mtime}
+                and current["requirements"] == lock.normalize_requirements(requirements)
+            ):
+                return []
+            todo = lock.outdated(
+                self.python_tag, requirements, current, lock.installed_state(self.site_packages)
+            )
+            if not todo and current:
+                self._write_stamp(current["hash"])
+            return todo
+
+    def pinned(self, requirements, lock_file=LOCK):
+        """Return requirements pinned to the lock file, the key of the environment cache."""
+        return lock.pinned(self.python_tag, requirements, read_json(lock_file))
+
+    def write_lock(self, requirements, lock_file=LOCK):
+        """Record the installed state as the lock of requirements."""
+        current = lock.build_lock(
+            self.python_tag, requirements, lock.installed_state(self.site_packages)
+        )
+        write_json(lock_file, current)
+        self._write_stamp(current["hash"])
+
+    def _write_stamp(self, lock_hash):
+        write_json(
+            os.path.join(self.venv_dir, lock.STAMP),
+            {"lock": lock_hash, "mtime": os.stat(self.site_packages).st_mtime_ns},
         )
-        if process.stdout:
-            for line in iter(process.stdout.readline, ""):
-                yield line.strip()
-        elif process.stderr:
-            for line in iter(process.stderr.readline, ""):
-                yield line.strip()
-        process.wait()
+
+    def install(self, package_name):
+        yield from self._pip("install", package_name)
+
+    def install_many(self, packages):
+        """Install all packages with a single pip (and resolver) run.
+
+        Yields pip's output lines; raises CalledProcessError if pip fails, in
+        which case nothing from the batch was installed.
+        """
+        yield from self._pip("install", *packages)
+
+    def _pip(self, *args):
+        with span(f"pip {args[0]}", packages=len(args) - 1):
+            process = subprocess.Popen(
+                [self.venv_python, "-u", "-m", "pip", *args],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                bufsize=1,  # Line buffered
+            )
+            if process.stdout:
+                for line in iter(process.stdout.readline, ""):
+                    yield line.strip()
+            elif process.stderr:
+                for line in iter(process.stderr.readline, ""):
+                    yield line.strip()
+            process.wait()
         if process.returncode != 0:
             raise subprocess.CalledProcessError(process.returncode, process.args)
 
     def run(self, file_name, flags="", env={}):
         """Run a script inside the virtual environment with optional flags."""
         command = [self.venv_python, file_name] + flags.split()
-        return subprocess.run(command, check=True, env=env).returncode
+        with span("run program"):
+            return subprocess.run(command, check=True, env=env).returncode
 
     def run_sandbox(self, file_name, flags="", env={}, memory=-1, cpu_time=-1, freq=-1):
         command = [self.venv_python, file_name] + flags.split()
         command = " ".join(command)
         command = ["sudo", "choco-sandbox", command, memory, cpu_time, freq]
-        return subprocess.run(command, check=True, env=env).returncode
+        with span("run program"):
+            return subprocess.run(command, check=True, env=env).returncode
+
 
+def find_python_files(directory, exclude=()):
+    """Recursively find all Python files in a directory.
+
+    Trees matching the exclude patterns (and the default ones, like venv/)
+    are not entered.
+    """
+    from ignore import ExcludeMatcher
 
-def find_python_files(directory):
-    """Recursively find all Python files in a directory."""
     python_files = []
-    for root, dirs, files in os.walk(directory):
+    for root, files in ExcludeMatcher(exclude).walk(directory):
         for file in files:
             if file.endswith(".py"):
                 python_files.append(os.path.join(root, file))
@@ -95,11 +289,11 @@ def find_python_files(directory):
 
 
 def extract_imports(file_path):
-    """Extract imports from a Python file."""
+    """Extract absolute imports from a Python file."""
     with open(file_path, "r", encoding="utf-8") as file:
         try:
             tree = ast.parse(file.read())
-        except SyntaxError as e:
+        except (SyntaxError, ValueError) as e:
             print(f"Syntax error in {file_path}: {e}")
             return []
 
@@ -108,46 +302,112 @@ def extract_imports(file_path):
         if isinstance(node, ast.Import):
             for alias in node.names:
                 imports.append(alias.name)
-        elif isinstance(node, ast.ImportFrom):
+        elif isinstance(node, ast.ImportFrom) and not node.level:
             imports.append(node.module)
 
     return imports
 
 
-def collect_imports(directory):
+def parse_files(python_files, workers=None, cache_file=None):
+    """Return {path: imports} for python_files.
+
+    Files are parsed on a process pool. With a cache file, files whose mtime
+    and size did not change since the last scan are not parsed again.
+    """
+    started = time.time_ns()
+    cache = (read_json(cache_file) if cache_file else None) or {}
+    entries = {}
+    todo = []
+    for path in python_files:
+        st = os.stat(path)
+        stamp = [st.st_mtime_ns, st.st_size]
+        if cache.get(path, [])[:2] == stamp:
+            entries[path] = cache[path]
+        else:
+            # A file written within the last 2 seconds may change again
+            # without a new mtime, store it with a stamp that never matches.
+            if started - st.st_mtime_ns < 2_000_000_000:
+                stamp[0] = 0
+            entries[path] = stamp + [None]
+            todo.append(path)
+
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(todo) >= PARALLEL_MIN:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(workers) as pool:
+            chunks = max(1, len(todo) // (workers * 4))
+            results = list(pool.map(extract_imports, todo, chunksize=chunks))
+    else:
+        results = map(extract_imports, todo)
+    for path, imports in zip(todo, results):
+        entries[path][2] = sorted(set(filter(None, imports)))
+
+    if cache_file and (todo or len(entries) != len(cache)):
+        os.makedirs(os.path.dirname(cache_file) or ".", exist_ok=True)
+        write_json(cache_file, entries)
+    return {path: entry[2] for path, entry in entries.items()}
+
+
+def collect_imports(directory, exclude=(), workers=None, cache_file=None):
     """Collect all unique imports from Python files in a directory."""
-    python_files = find_python_files(directory)
     all_imports = set()
-
-    for file_path in python_files:
-        imports = extract_imports(file_path)
+    for imports in parse_files(find_python_files(directory, exclude), workers, cache_file).values():
         all_imports.update(imports)
-
     return all_imports
 
 
 def get_builtin_libraries():
-    """Return a set of built-in libraries."""
-    return set(sys.builtin_module_names)
+    """Return a set of built-in and standard libraries."""
+    names = getattr(sys, "stdlib_module_names", None)
+    if names is None:  # Python < 3.10, list the standard library folder.
+        import pkgutil
+        import sysconfig
 
+        stdlib = sysconfig.get_paths()["stdlib"]
+        paths = [stdlib, os.path.join(stdlib, "lib-dynload")]
+        names = {module.name for module in pkgutil.iter_modules(paths)}
+        names.discard("site-packages")
+    return set(sys.builtin_module_names) | set(names)
 
-def export_non_builtin_imports(imports, output_file):
-    """Export only non-builtin imports to a file, filtering out None values."""
-    # Get the set of built-in libraries
-    builtin_libraries = get_builtin_libraries()
 
-    # Filter out built-in libraries and None values from the imports
-    non_builtin_imports = {
-        imp for imp in imports if imp not in builtin_libraries and imp is not None
-    }
+def local_modules(python_files):
+    """Top-level names a project file could be imported as."""
+    names = set()
+    for path in python_files:
+        parts = os.path.normpath(path).split(os.sep)
+        names.add(parts[-1][: -len(".py")])
+        names.update(parts[:-1])
+    return names
 
-    # Write the remaining non-builtin imports to the file
-    with open(output_file, "w", encoding="utf-8") as file:
-        for imp in sorted(non_builtin_imports):
-            file.write(f"{imp}\n")
+
+def third_party_imports(directory=".", exclude=(), workers=None, cache_file=IMPORT_CACHE):
+    """Sorted top-level modules imported by the project that it doesn't provide.
+
+    Standard library modules and the project's own modules and packages are
+    left out.
+    """
+    with span("find python files") as counts:
+        python_files = find_python_files(directory, exclude)
+        counts["files"] = len(python_files)
+    imports = set()
+    with span("parse imports", files=len(python_files)):
+        parsed = parse_files(python_files, workers, cache_file)
+    for names in parsed.values():
+        imports.update(name.partition(".")[0] for name in names)
+    return sorted(imports - get_builtin_libraries() - local_modules(python_files))
 
 
-def exporter(directory, output_file):
-    imports = collect_imports(directory)
-    export_non_builtin_imports(imports, output_file)
-    print(f"Exported non-builtin imports to {output_file}")
+def exporter(directory, output_file, venv_dir="venv"):
+    """Write the distributions the code in directory needs, one per line.
+
+    Imports that no package in venv_dir provides are written as they are.
+    """
+    modules = third_party_imports(directory)
+    requirements, unresolved = requirements_for(modules, module_index(venv_dir))
+    with open(output_file, "w", encoding="utf-8") as file:
+        for name in sorted(requirements + unresolved, key=str.lower):
+            file.write(f"{name}\n")
+    if unresolved:
+        print(f"Not installed in {venv_dir}: {', '.join(unresolved)}")
+    print(f"Exported requirements to {output_file}")
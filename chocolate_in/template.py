@@ -52,11 +52,130 @@ venv/bin/python {} $FLAGS
 """
 
 
-hashfind = """
+hashfind = r"""
 #!/bin/bash
-find . -type f ! -path "./venv/*" ! -path "./logs/*" | while read -r file; do
-    hash=$(sha256sum "$file" | awk '{print $1}')
-    relpath="${file#./}"  # remove leading ./ for clean output
-    echo "$relpath=$hash"
-done
+# Prints "path=sha256" for every file of the project. Digests are kept in
+# .choco_manifest (also written by chocolate after each sync) and only files
+# whose size or mtime changed since are hashed again, in parallel.
+# Paths matching CHOCO_EXCLUDE (the project's exclude patterns) are skipped.
+export CHOCO_EXCLUDE=@EXCLUDE@
+if ! command -v python3 >/dev/null 2>&1; then
+    find . -type f ! -name ".choco_manifest*" | sed 's|^\./||' | grep -Ev "$CHOCO_EXCLUDE" | while read -r relpath; do
+        hash=$(sha256sum "$relpath" | awk '{print $1}')
+        echo "$relpath=$hash"
+    done
+    exit 0
+fi
+
+exec python3 - <<'PY'
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST = ".choco_manifest"
+EXCLUDE = re.compile(os.environ["CHOCO_EXCLUDE"])
+
+
+def sha256(path):
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(1 << 20), b""):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+try:
+    with open(MANIFEST) as fp:
+        old = json.load(fp)["files"]
+except Exception:
+    old = {}
+
+files, stale = {}, []
+for root, dirs, names in os.walk("."):
+    rel = "" if root == "." else os.path.relpath(root, ".") + "/"
+    dirs[:] = [d for d in dirs if not EXCLUDE.match(f"{rel}{d}/")]
+    for name in names:
+        path = rel + name
+        if path.startswith(MANIFEST) or EXCLUDE.match(path):
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        key = [st.st_size, int(st.st_mtime)]
+        entry = old.get(path)
+        if entry and entry[:2] == key:
+            files[path] = entry
+        else:
+            stale.append((path, key))
+
+with ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as pool:
+    for (path, key), digest in zip(stale, pool.map(sha256, [p for p, _ in stale])):
+        if digest:
+            files[path] = key + [digest]
+
+for path, entry in files.items():
+    print(f"{path}={entry[2]}")
+
+if stale or len(files) != len(old):
+    with open(MANIFEST + ".tmp", "w") as fp:
+        json.dump({"version": 1, "files": files}, fp)
+    os.replace(MANIFEST + ".tmp", MANIFEST)
+PY
+"""
+
+
+# Used by delta uploads: `python3 -c delta_signature <path> <block size>`
+# prints "adler32 blake2b" for every block of the remote copy.
+delta_signature = """
+import hashlib, sys, zlib
+path, block = sys.argv[1], int(sys.argv[2])
+with open(path, "rb") as fp:
+    for chunk in iter(lambda: fp.read(block), b""):
+        digest = hashlib.blake2b(chunk, digest_size=16).hexdigest()
+        sys.stdout.write(f"{zlib.adler32(chunk)} {digest}\\n")
+"""
+
+# `python3 -c delta_patch <path> <block size> <sha256>` rebuilds the file from
+# the copy/literal operations on stdin next to the old one, checks the result
+# and atomically replaces the old file.
+delta_patch = """
+import hashlib, os, shutil, struct, sys
+path, block, expected = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+tmp = path + ".choco_delta"
+src = sys.stdin.buffer
+
+def read(n):
+    data = src.read(n)
+    if len(data) != n:
+        raise ValueError("truncated delta")
+    return data
+
+try:
+    digest = hashlib.sha256()
+    with open(path, "rb") as old, open(tmp, "wb") as new:
+        while True:
+            op = read(1)
+            if op == b"E":
+                break
+            if op == b"C":
+                old.seek(struct.unpack(">Q", read(8))[0] * block)
+                data = old.read(block)
+            else:
+                data = read(struct.unpack(">I", read(4))[0])
+            new.write(data)
+            digest.update(data)
+    if digest.hexdigest() != expected:
+        raise ValueError("checksum mismatch after patching")
+    shutil.copymode(path, tmp)
+    os.replace(tmp, path)
+except BaseException as e:
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    sys.exit(f"delta failed: {e}")
 """
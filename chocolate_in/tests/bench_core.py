@@ -0,0 +1,316 @@
+"""Benchmarks for the hot paths of chocolate.
+
+Generates a synthetic project and times, in process:
+    hash             get_file_hash over every file
+    zip              create_zip from scratch
+    zip incremental  create_zip again, reusing the previous archive
+    imports          collect_imports without a cache
+    imports cached   collect_imports with a warm per-file cache
+    config           JsonConfig load, set and commit round-trips
+    sync             a full Sftp.sync to an empty server
+    sync unchanged   Sftp.sync again, nothing to upload
+
+Sync runs against the SSH stand-in in sshstandin.py, with the latency and
+bandwidth given on the command line. MB is what a benchmark read (hash),
+wrote (zip, config) or sent (sync).
+
+Usage:
+    python chocolate_in/tests/bench_core.py [-n RUNS] [--files N] [--size BYTES]
+                                            [--depth N] [--latency SECONDS]
+                                            [--bandwidth BYTES_PER_S]
+                                            [--json FILE] [--compare FILE]
+                                            [benchmark ...]
+
+--json stores the results with the chocolate version and commit they were
+measured on, --compare prints the change against such a file.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import re
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SOURCE = os.path.dirname(HERE)
+sys.path.insert(0, SOURCE)
+
+BENCHMARKS = [
+    "hash",
+    "zip",
+    "zip incremental",
+    "imports",
+    "imports cached",
+    "config",
+    "sync",
+    "sync unchanged",
+]
+
+# Third-party names sprinkled into generated modules so the import scanner
+# has something to find.
+IMPORTS = ["os", "sys", "json", "requests", "numpy", "yaml", "rich.console", "flask"]
+
+
+def make_project(root, files, size, depth, seed=1):
+    """Create a project of files spread over depth levels of folders.
+
+    File sizes follow a log-normal distribution around size. A third of the
+    files are Python modules, a tenth are random bytes that don't compress,
+    the rest is text.
+    """
+    import project_manager as prj
+
+    rng = random.Random(seed)
+    os.makedirs(root)
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        prj.setup_project("bench", "main.py")
+    finally:
+        os.chdir(cwd)
+    folders = level = [""]
+    for n in range(depth):
+        level = [os.path.join(parent, f"dir{n}_{i}") for parent in level for i in range(3)]
+        folders = folders + level
+    total = 0
+    for i in range(files):
+        folder = os.path.join(root, rng.choice(folders))
+        os.makedirs(folder, exist_ok=True)
+        length = max(16, min(int(rng.lognormvariate(math.log(size), 1.0)), size * 64))
+        kind = rng.random()
+        if kind < 0.1:
+            name, data = f"blob{i}.bin", rng.randbytes(length)
+        elif kind < 0.43:
+            lines = [f"import {name}" for name in rng.sample(IMPORTS, 3)]
+            while sum(map(len, lines)) < length:
+                n = len(lines)
+                lines.append(f"def f{n}(a, b):\n    return a * {n} + b\n")
+            name, data = f"mod{i}.py", "\n".join(lines).encode()
+        else:
+            words = rng.choices(("alpha", "beta", "gamma", "delta", "chocolate"), k=length // 6)
+            name, data = f"note{i}.txt", " ".join(words).encode()
+        with open(os.path.join(folder, name), "wb") as fp:
+            fp.write(data)
+        total += len(data)
+    # Caches don't trust files modified in the last seconds, age them so the
+    # incremental benchmarks see a settled project.
+    old = time.time() - 3600
+    for folder, _, names in os.walk(root):
+        for name in names:
+            os.utime(os.path.join(folder, name), (old, old))
+    return total
+
+
+def project_files(root):
+    from ignore import ExcludeMatcher
+
+    return list(ExcludeMatcher().files(root))
+
+
+class Bench:
+    """Holds the generated project and the state shared between benchmarks."""
+
+    def __init__(self, workdir, args):
+        # Import everything up front so no benchmark pays for the imports.
+        import archive, config, project_manager, sftp, sshstandin  # noqa: F401
+
+        self.args = args
+        self.workdir = workdir
+        self.project = os.path.join(workdir, "project")
+        self.remote = os.path.join(workdir, "remote")
+        self.size = make_project(self.project, args.files, args.size, args.depth)
+        self.files = project_files(self.project)
+        self.server = None
+        os.chdir(self.project)
+
+    def close(self):
+        if self.server:
+            self.server.close()
+
+    def hash(self):
+        from sftp import get_file_hash
+
+        for path in self.files:
+            get_file_hash(path)
+        return len(self.files), self.size
+
+    def zip(self, incremental=False):
+        from config import create_zip
+
+        output = os.path.join(self.workdir, "bench.zip")
+        state = os.path.join(self.workdir, "exports.json")
+        if not incremental:
+            for path in (output, state):
+                if os.path.exists(path):
+                    os.remove(path)
+        count, _ = create_zip(output, ".", [], state=state)
+        return count, os.path.getsize(output)
+
+    def imports(self, cached=False):
+        from project_manager import collect_imports
+
+        cache = os.path.join(self.workdir, "imports.json")
+        if not cached and os.path.exists(cache):
+            os.remove(cache)
+        collect_imports(".", cache_file=cache)
+        return len([path for path in self.files if path.endswith(".py")]), None
+
+    def config(self, rounds=100):
+        from config import JsonConfig
+
+        name = os.path.join(self.workdir, "config.json")
+        with open(name, "w") as fp:
+            json.dump(
+                {"environmentVariables": {f"KEY{i}": f"value{i}" for i in range(1000)}}, fp
+            )
+        for i in range(rounds):
+            config = JsonConfig(name)
+            config["flagsString"] = f"--round {i}"
+        return rounds, os.path.getsize(name)
+
+    def sync(self, unchanged=False):
+        from ignore import ExcludeMatcher
+        from sftp import Sftp
+        from template import hashfind
+
+        if self.server is None:
+            from sshstandin import SSHStandIn
+
+            os.makedirs(self.remote)
+            self.server = SSHStandIn(self.remote, self.args.latency, self.args.bandwidth)
+            with open("hash.sh", "w") as fp:
+                fp.write(hashfind.replace("@EXCLUDE@", shlex.quote(ExcludeMatcher().pattern)))
+        if not unchanged:
+            shutil.rmtree(os.path.join(self.remote, "bench"), ignore_errors=True)
+            shutil.rmtree(".choco_cache", ignore_errors=True)
+        client = Sftp("127.0.0.1", "bench", "bench", self.server.port, idle_timeout=0)
+        try:
+            stats = client.sync("bench", [], 4, True, 8 * 1024 * 1024, 200)
+        finally:
+            client.close()
+        return stats["files"], stats["bytes"]
+
+    def run(self, name):
+        """Return (seconds, files, bytes) of one run of the named benchmark."""
+        method, _, variant = name.partition(" ")
+        call = getattr(self, method)
+        # "incremental", "cached" and "unchanged" first bring the state up to
+        # date, only the second call is timed.
+        if variant:
+            call(True)
+            start = time.perf_counter()
+            files, size = call(True)
+        else:
+            start = time.perf_counter()
+            files, size = call()
+        return time.perf_counter() - start, files, size
+
+
+def version():
+    """The chocolate version and git commit the benchmark ran against."""
+    with open(os.path.join(SOURCE, "main.py")) as fp:
+        release = re.search(r"\[blue\]Chocolate \[/blue\]\(([^)]+)\)", fp.read())
+    release = release and release.group(1)
+    try:
+        commit = subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=SOURCE,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return release, commit
+
+
+def bench(names, args):
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        runner = Bench(workdir, args)
+        try:
+            for name in names:
+                seconds = []
+                for _ in range(args.runs):
+                    elapsed, files, size = runner.run(name)
+                    seconds.append(elapsed)
+                results[name] = {
+                    "ms": round(statistics.median(seconds) * 1000, 2),
+                    "files": files,
+                    "bytes": size,
+                }
+        finally:
+            runner.close()
+            os.chdir(cwd)
+    return results
+
+
+def report(results, baseline=None):
+    header = f"{'benchmark':<18}{'ms':>11}{'files':>8}{'MB':>9}{'MB/s':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, res in results.items():
+        mb = res["bytes"] / 1e6 if res["bytes"] is not None else None
+        rate = f"{mb / (res['ms'] / 1000):>9.1f}" if mb and res["ms"] else f"{'-':>9}"
+        size = f"{mb:>9.2f}" if mb is not None else f"{'-':>9}"
+        line = f"{name:<18}{res['ms']:>11}{res['files']:>8}{size}{rate}"
+        if baseline and name in baseline["results"] and baseline["results"][name]["ms"]:
+            change = res["ms"] / baseline["results"][name]["ms"] - 1
+            line += f"  ({change:+.1%} vs {baseline['commit'] or baseline['version']})"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chocolate hot path benchmarks.")
+    parser.add_argument("benchmarks", nargs="*", default=BENCHMARKS)
+    parser.add_argument("-n", "--runs", type=int, default=3)
+    parser.add_argument("--files", type=int, default=500, help="Files in the project.")
+    parser.add_argument("--size", type=int, default=4096, help="Median file size in bytes.")
+    parser.add_argument("--depth", type=int, default=3, help="Folder nesting levels.")
+    parser.add_argument("--latency", type=float, default=0.0, help="One-way latency in seconds.")
+    parser.add_argument("--bandwidth", type=int, default=0, help="Bytes per second, 0 is unlimited.")
+    parser.add_argument("--json", help="Write the results to this file.")
+    parser.add_argument("--compare", help="Baseline results written by --json.")
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    results = bench(args.benchmarks, args)
+    shape = {
+        key: getattr(args, key) for key in ("runs", "files", "size", "depth", "latency", "bandwidth")
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+    report(results, baseline)
+    if baseline and baseline["shape"] != shape:
+        print(f"Note: the baseline was measured with {baseline['shape']}.")
+    if args.json:
+        release, commit = version()
+        with open(args.json, "w") as fp:
+            json.dump(
+                {
+                    "version": release,
+                    "commit": commit,
+                    "python": sys.version.split()[0],
+                    "shape": shape,
+                    "results": results,
+                },
+                fp,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
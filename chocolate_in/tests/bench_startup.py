@@ -0,0 +1,139 @@
+"""Cold-start benchmark for the chocolate CLI.
+
+Runs `python -X importtime main.py <action>` for every action and reports the
+import cost, the number of imported modules and the wall-clock time of the
+whole invocation. Each run gets a fresh copy of a template project, made
+before the clock starts, so actions that write (`flags`, `export`) can't
+change what later runs see.
+
+Usage:
+    python chocolate_in/tests/bench_startup.py [-n RUNS] [--json FILE]
+                                               [--compare FILE] [action ...]
+
+Actions are given as they would be typed after `chocolate`, e.g. "env list".
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+
+DEFAULT_ACTIONS = [
+    "version",
+    "help",
+    "config",
+    "env list",
+    "path list",
+    "flags",
+    "export -o bench.zip",
+]
+
+# Modules that should only be imported by the actions that really need them.
+HEAVY_MODULES = ("paramiko", "rich.live", "rich.markdown", "rich.pretty", "logging.handlers")
+
+
+def parse_importtime(stderr):
+    """Return (total import time in us, imported module names) from -X importtime output."""
+    total = 0
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.append(name.strip())
+        # Nested imports are indented by two spaces per level, top-level by one.
+        if not name[1:].startswith(" "):
+            total += int(cumulative)
+    return total, modules
+
+
+def run_action(action, cwd):
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", MAIN, *action.split()],
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        stdin=subprocess.DEVNULL,
+        text=True,
+    )
+    wall = time.perf_counter() - start
+    total, modules = parse_importtime(proc.stderr)
+    return wall, total, modules
+
+
+def make_project(directory):
+    subprocess.run(
+        [sys.executable, MAIN, "new", "bench", "main.py"],
+        cwd=directory,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+
+
+def bench(actions, runs):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        template = os.path.join(directory, "template")
+        os.makedirs(template)
+        make_project(template)
+        for action in actions:
+            walls, imports = [], []
+            modules = []
+            for _ in range(runs):
+                project = os.path.join(directory, "run")
+                shutil.rmtree(project, ignore_errors=True)
+                shutil.copytree(template, project)
+                wall, total, modules = run_action(action, project)
+                walls.append(wall)
+                imports.append(total)
+            results[action] = {
+                "wall_ms": round(statistics.median(walls) * 1000, 2),
+                "import_ms": round(statistics.median(imports) / 1000, 2),
+                "modules": len(modules),
+                "heavy": sorted(m for m in set(modules) if m in HEAVY_MODULES),
+            }
+    return results
+
+
+def report(results, baseline=None):
+    header = f"{'action':<22}{'wall ms':>10}{'import ms':>11}{'modules':>9}  heavy"
+    print(header)
+    print("-" * len(header))
+    for action, res in results.items():
+        line = f"{action:<22}{res['wall_ms']:>10}{res['import_ms']:>11}{res['modules']:>9}  {', '.join(res['heavy']) or '-'}"
+        if baseline and action in baseline:
+            delta = res["import_ms"] - baseline[action]["import_ms"]
+            line += f"  ({delta:+.2f} ms import vs baseline)"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chocolate CLI cold-start benchmark.")
+    parser.add_argument("actions", nargs="*", default=DEFAULT_ACTIONS)
+    parser.add_argument("-n", "--runs", type=int, default=5)
+    parser.add_argument("--json", help="Write the results to this file.")
+    parser.add_argument("--compare", help="Baseline results written by --json.")
+    args = parser.parse_args()
+
+    results = bench(args.actions, args.runs)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+    report(results, baseline)
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+"""In-process SSH/SFTP server stand-in used to exercise Sftp without a real host.
+
+    server = SSHStandIn("/tmp/remote", latency=0.02, bandwidth=10 * 1024 * 1024)
+    client = Sftp("127.0.0.1", "user", "any password", server.port, idle_timeout=0)
+
+Exec requests run through bash with HOME set to the root folder, SFTP paths
+are confined to it. Latency (seconds, one way) is added to every request and
+bandwidth (bytes/s) limits file reads, writes and exec input.
+
+Standalone: python sshstandin.py <root> [latency] [bandwidth] prints the port.
+"""
+
+import logging
+import os
+import socket
+import subprocess
+import threading
+import time
+
+import paramiko
+from paramiko.sftp import SFTP_OK
+
+logging.getLogger("sshstandin").setLevel(logging.CRITICAL)
+
+
+class Link:
+    """Injected network conditions: one-way latency and bandwidth in bytes/s."""
+
+    def __init__(self, latency=0.0, bandwidth=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def delay(self, size=0):
+        wait = self.latency
+        if self.bandwidth:
+            wait += size / self.bandwidth
+        if wait:
+            time.sleep(wait)
+
+
+class _Handle(paramiko.SFTPHandle):
+    def __init__(self, link, flags=0):
+        super().__init__(flags)
+        self.link = link
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def write(self, offset, data):
+        self.link.delay(len(data))
+        return super().write(offset, data)
+
+    def read(self, offset, length):
+        self.link.delay(length)
+        return super().read(offset, length)
+
+
+class _SFTP(paramiko.SFTPServerInterface):
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = server.root
+        self.link = server.link
+
+    def _path(self, path):
+        path = path.replace("\\", "/")
+        if path.startswith("/"):
+            path = path.lstrip("/")
+        full = os.path.normpath(os.path.join(self.root, path))
+        if not (full == self.root or full.startswith(self.root + os.sep)):
+            full = self.root
+        return full
+
+    def canonicalize(self, path):
+        full = self._path(path)
+        return "/" + os.path.relpath(full, self.root).replace(os.sep, "/").lstrip(".")
+
+    def list_folder(self, path):
+        self.link.delay()
+        full = self._path(path)
+        try:
+            out = []
+            for name in os.listdir(full):
+                attr = paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(full, name)))
+                attr.filename = name
+                out.append(attr)
+            return out
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        self.link.delay()
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        self.link.delay()
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self._path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        self.link.delay()
+        full = self._path(path)
+        try:
+            binary_flag = getattr(os, "O_BINARY", 0)
+            fd = os.open(full, flags | binary_flag, 0o666)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_CREAT and attr is not None:
+            attr._flags &= ~attr.FLAG_PERMISSIONS
+            paramiko.SFTPServer.set_file_attr(full, attr)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        try:
+            f = os.fdopen(fd, mode)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = _Handle(self.link, flags)
+        handle.filename = full
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def remove(self, path):
+        self.link.delay()
+        try:
+            os.remove(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        self.link.delay()
+        try:
+            os.rename(self._path(oldpath), self._path(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        return self.rename(oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        self.link.delay()
+        try:
+            os.mkdir(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rmdir(self, path):
+        self.link.delay()
+        try:
+            os.rmdir(self._path(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        self.link.delay()
+        try:
+            paramiko.SFTPServer.set_file_attr(self._path(path), attr)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+
+class _Server(paramiko.ServerInterface):
+    def __init__(self, stand_in):
+        self.root = stand_in.root
+        self.link = stand_in.link
+        self.stand_in = stand_in
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OR_UNKNOWN_KIND
+
+    def check_channel_exec_request(self, channel, command):
+        self.stand_in.commands.append(command.decode())
+        threading.Thread(
+            target=self._exec, args=(channel, command.decode()), daemon=True
+        ).start()
+        return True
+
+    def _exec(self, channel, command):
+        self.link.delay()
+        env = dict(os.environ, HOME=self.root)
+        proc = subprocess.Popen(
+            ["bash", "-c", command],
+            cwd=self.root,
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+        def feed():
+            try:
+                while True:
+                    data = channel.recv(32768)
+                    if not data:
+                        break
+                    self.link.delay(len(data))
+                    proc.stdin.write(data)
+                proc.stdin.close()
+            except (OSError, ValueError):
+                pass
+
+        def pump(stream, send):
+            for chunk in iter(lambda: stream.read1(32768), b""):
+                send(chunk)
+
+        threads = [
+            threading.Thread(target=feed, daemon=True),
+            threading.Thread(target=pump, args=(proc.stderr, channel.sendall_stderr)),
+        ]
+        for thread in threads:
+            thread.start()
+        pump(proc.stdout, channel.sendall)
+        threads[1].join()
+        code = proc.wait()
+        channel.send_exit_status(code)
+        channel.shutdown_write()
+        channel.close()
+
+
+class SSHStandIn:
+    """Run an SSH server on 127.0.0.1 whose remote home directory is `root`."""
+
+    def __init__(self, root, latency=0.0, bandwidth=0):
+        self.root = os.path.realpath(root)
+        self.link = Link(latency, bandwidth)
+        self.key = paramiko.RSAKey.generate(2048)
+        self.commands = []
+        self.connections = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            transport = paramiko.Transport(client)
+            # Clients hanging up are expected, keep the resets out of the output.
+            transport.set_log_channel("sshstandin")
+            transport.add_server_key(self.key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, _SFTP)
+            server = _Server(self)
+            transport.start_server(server=server)
+            self.transports.append(transport)
+
+    def close(self):
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
+
+
+if __name__ == "__main__":
+    import sys
+
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+    bandwidth = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    server = SSHStandIn(sys.argv[1], latency, bandwidth)
+    print(server.port, flush=True)
+    while True:
+        time.sleep(3600)
@@ -0,0 +1,131 @@
+import os
+import random
+import struct
+import time
+import zipfile
+
+import pytest
+
+import archive
+from archive import DEFLATED, STORED, write_zip
+
+
+def make_files(root, files):
+    """Write {arcname: bytes} under root, aged past Previous.RACY_NS."""
+    old = time.time() - 3600
+    result = []
+    for arcname, data in files.items():
+        path = os.path.join(root, arcname)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fp:
+            fp.write(data)
+        os.utime(path, (old, old))
+        result.append((path, arcname))
+    return result
+
+
+def check(name, files):
+    """Assert the archive is valid and holds exactly files, return its infos."""
+    with zipfile.ZipFile(name) as zf:
+        assert zf.testzip() is None
+        assert sorted(zf.namelist()) == sorted(files)
+        for arcname, data in files.items():
+            assert zf.read(arcname) == data
+        return {info.filename: info for info in zf.infolist()}
+
+
+@pytest.fixture
+def sample():
+    rng = random.Random(1)
+    return {
+        "main.py": b"print('hello')\n" * 500,
+        "pkg/notes.txt": " ".join(rng.choices(["alpha", "beta", "gamma"], k=4000)).encode(),
+        "pkg/blob.bin": rng.randbytes(200_000),
+        "img/logo.png": b"not really a png, but never deflated\n" * 100,
+        "empty.txt": b"",
+        "café.txt": b"non-ascii name\n",
+    }
+
+
+def test_stored_and_deflated(tmp_path, sample):
+    name = str(tmp_path / "out.zip")
+    assert write_zip(name, make_files(str(tmp_path / "src"), sample), workers=2) == (6, 0)
+    infos = check(name, sample)
+    assert infos["main.py"].compress_type == DEFLATED
+    assert infos["pkg/notes.txt"].compress_type == DEFLATED
+    assert infos["pkg/blob.bin"].compress_type == STORED  # Incompressible.
+    assert infos["img/logo.png"].compress_type == STORED  # By suffix.
+    assert infos["main.py"].compress_size < len(sample["main.py"])
+
+
+def test_level_zero_stores_everything(tmp_path, sample):
+    name = str(tmp_path / "out.zip")
+    write_zip(name, make_files(str(tmp_path / "src"), sample), level=0)
+    infos = check(name, sample)
+    assert {info.compress_type for info in infos.values()} == {STORED}
+
+
+def test_zip64(tmp_path, sample, monkeypatch):
+    monkeypatch.setattr(archive, "ZIP64_LIMIT", 64)
+    name = str(tmp_path / "out.zip")
+    write_zip(name, make_files(str(tmp_path / "src"), sample))
+    infos = check(name, sample)
+    # Central directory entries carry the ZIP64 extra field (header id 1).
+    assert struct.unpack("<H", infos["pkg/blob.bin"].extra[:2])[0] == 1
+    with open(name, "rb") as fp:
+        assert b"PK\x06\x06" in fp.read()  # ZIP64 end of central directory.
+
+
+def test_reuse_after_mtime_change(tmp_path, sample):
+    name = str(tmp_path / "out.zip")
+    state = str(tmp_path / "exports.json")
+    files = make_files(str(tmp_path / "src"), sample)
+    assert write_zip(name, files, state=state) == (6, 0)
+    # Unchanged stat: copied from the previous archive.
+    assert write_zip(name, files, state=state) == (6, 6)
+    # Same content with a new mtime: the digest still matches.
+    os.utime(files[0][0])
+    assert write_zip(name, files, state=state) == (6, 6)
+    infos = check(name, sample)
+    assert infos["main.py"].compress_type == DEFLATED
+
+
+def test_reuse_after_content_change(tmp_path, sample):
+    name = str(tmp_path / "out.zip")
+    state = str(tmp_path / "exports.json")
+    files = make_files(str(tmp_path / "src"), sample)
+    write_zip(name, files, state=state)
+    # Same size and mtime, different bytes.
+    path = os.path.join(str(tmp_path / "src"), "pkg", "notes.txt")
+    st = os.stat(path)
+    sample["pkg/notes.txt"] = sample["pkg/notes.txt"].replace(b"alpha", b"omega")
+    with open(path, "wb") as fp:
+        fp.write(sample["pkg/notes.txt"])
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    assert write_zip(name, files, state=state) == (6, 5)
+    check(name, sample)
+
+
+def test_reuse_in_zip64_archive(tmp_path, sample, monkeypatch):
+    monkeypatch.setattr(archive, "ZIP64_LIMIT", 64)
+    name = str(tmp_path / "out.zip")
+    state = str(tmp_path / "exports.json")
+    files = make_files(str(tmp_path / "src"), sample)
+    write_zip(name, files, state=state)
+    assert write_zip(name, files, state=state) == (6, 6)
+    check(name, sample)
+
+
+def test_no_reuse(tmp_path, sample):
+    name = str(tmp_path / "out.zip")
+    state = str(tmp_path / "exports.json")
+    files = make_files(str(tmp_path / "src"), sample)
+    write_zip(name, files, state=state)
+    assert write_zip(name, files, state=state, incremental=False) == (6, 0)
+    # Another compression level never reuses members.
+    assert write_zip(name, files, level=1, state=state) == (6, 0)
+    # Neither does an archive that changed since the state was saved.
+    with open(name, "ab") as fp:
+        fp.write(b"junk")
+    assert write_zip(name, files, level=1, state=state) == (6, 0)
+    check(name, sample)
@@ -0,0 +1,167 @@
+import hashlib
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+import delta
+from template import delta_patch, delta_signature
+
+BLOCK = 2048
+
+
+def data(size, seed=1):
+    return random.Random(seed).randbytes(size)
+
+
+def signature(path, block):
+    """Run the remote signature script on path."""
+    return subprocess.run(
+        [sys.executable, "-c", delta_signature, path, str(block)],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+
+
+def patch(path, block, ops, expected):
+    """Run the remote patch script on path with ops on stdin."""
+    return subprocess.run(
+        [sys.executable, "-c", delta_patch, path, str(block), expected],
+        input=ops,
+        capture_output=True,
+    )
+
+
+def roundtrip(tmp_path, old, new, block=BLOCK):
+    """Patch a remote copy of old into new, return the bytes of the delta."""
+    remote = tmp_path / "remote.bin"
+    local = tmp_path / "local.bin"
+    remote.write_bytes(old)
+    local.write_bytes(new)
+    weak_map = delta.parse_signature(signature(str(remote), block))
+    ops = b"".join(delta.delta_ops(str(local), weak_map, block, len(new) + 1))
+    result = patch(str(remote), block, ops, hashlib.sha256(new).hexdigest())
+    assert result.returncode == 0, result.stderr
+    assert remote.read_bytes() == new
+    assert not os.path.exists(str(remote) + ".choco_delta")
+    return len(ops)
+
+
+def test_identical(tmp_path):
+    old = data(BLOCK * 20)
+    assert roundtrip(tmp_path, old, old) < BLOCK
+
+
+def test_insert(tmp_path):
+    old = data(BLOCK * 20)
+    new = old[: BLOCK * 7 + 100] + data(500, seed=2) + old[BLOCK * 7 + 100 :]
+    assert roundtrip(tmp_path, old, new) < 3 * BLOCK
+
+
+def test_delete(tmp_path):
+    old = data(BLOCK * 20)
+    new = old[: BLOCK * 5 + 10] + old[BLOCK * 6 + 700 :]
+    assert roundtrip(tmp_path, old, new) < 3 * BLOCK
+
+
+def test_append(tmp_path):
+    old = data(BLOCK * 20)
+    assert roundtrip(tmp_path, old, old + data(3000, seed=2)) < 3000 + BLOCK
+
+
+def test_truncate(tmp_path):
+    old = data(BLOCK * 20)
+    roundtrip(tmp_path, old, old[: BLOCK * 12 + 333])
+    roundtrip(tmp_path, old, old[: BLOCK * 12])
+
+
+def test_block_boundary_shift(tmp_path):
+    # One byte in front moves every block off its boundary.
+    old = data(BLOCK * 20)
+    assert roundtrip(tmp_path, old, b"x" + old) < 2 * BLOCK
+
+
+def test_short_last_block(tmp_path):
+    old = data(BLOCK * 20 + 100)
+    new = old[:BLOCK] + data(BLOCK, seed=2) + old[2 * BLOCK :]
+    assert roundtrip(tmp_path, old, new) < 2 * BLOCK
+
+
+def test_smaller_than_block(tmp_path):
+    old = data(BLOCK // 2)
+    roundtrip(tmp_path, old, old)
+    roundtrip(tmp_path, old, old[:100] + b"changed" + old[100:])
+
+
+def test_empty_files(tmp_path):
+    with pytest.raises(delta.DeltaTooLarge):
+        roundtrip(tmp_path, data(BLOCK * 4), b"")
+    with pytest.raises(delta.DeltaTooLarge):
+        roundtrip(tmp_path, b"", data(BLOCK * 4))
+
+
+def test_literal_budget(tmp_path):
+    local = tmp_path / "local.bin"
+    local.write_bytes(data(BLOCK * 20, seed=2))
+    remote = tmp_path / "remote.bin"
+    remote.write_bytes(data(BLOCK * 20))
+    weak_map = delta.parse_signature(signature(str(remote), BLOCK))
+    with pytest.raises(delta.DeltaTooLarge):
+        list(delta.delta_ops(str(local), weak_map, BLOCK, BLOCK * 10))
+
+
+def test_patch_rejects_wrong_checksum(tmp_path):
+    old = data(BLOCK * 4)
+    remote = tmp_path / "remote.bin"
+    remote.write_bytes(old)
+    ops = delta.encode_literal(b"other") + delta.END
+    result = patch(str(remote), BLOCK, ops, hashlib.sha256(b"wanted").hexdigest())
+    assert result.returncode != 0
+    assert remote.read_bytes() == old
+    assert not os.path.exists(str(remote) + ".choco_delta")
+
+
+def test_patch_rejects_truncated_delta(tmp_path):
+    old = data(BLOCK * 4)
+    remote = tmp_path / "remote.bin"
+    remote.write_bytes(old)
+    result = patch(str(remote), BLOCK, delta.encode_copy(0), hashlib.sha256(old).hexdigest())
+    assert result.returncode != 0
+    assert remote.read_bytes() == old
+
+
+def test_corrupted_signature():
+    with pytest.raises(ValueError):
+        delta.parse_signature("123 abc\nnot a signature line\n")
+
+
+def test_corrupted_signature_falls_back_to_full_upload(tmp_path, monkeypatch):
+    pytest.importorskip("paramiko")
+    import sftp
+    from sshstandin import SSHStandIn
+
+    root = tmp_path / "remote"
+    (root / "project").mkdir(parents=True)
+    old = data(BLOCK * 20)
+    new = b"x" + old
+    (root / "project" / "big.bin").write_bytes(old)
+    local = tmp_path / "big.bin"
+    local.write_bytes(new)
+    monkeypatch.setattr(sftp, "delta_signature", "print('garbage')")
+
+    server = SSHStandIn(str(root))
+    client = sftp.Sftp("127.0.0.1", "user", "password", server.port, idle_timeout=0)
+    try:
+        digest = hashlib.sha256(new).hexdigest()
+        plan = [(str(local), "big.bin", "project/big.bin", digest, True)]
+        stats = client.upload_many(plan, workers=1, delta_threshold=1)
+    finally:
+        client.close()
+        server.close()
+    assert stats["failed"] == 0
+    assert stats["saved"] == 0
+    assert stats["bytes"] == len(new)
+    assert (root / "project" / "big.bin").read_bytes() == new
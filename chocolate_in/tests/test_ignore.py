@@ -0,0 +1,189 @@
+import os
+import shlex
+import shutil
+import subprocess
+
+import pytest
+
+from ignore import DEFAULT_EXCLUDES, ExcludeMatcher, translate
+from template import hashfind
+
+# Relative paths of a sample project, folders are listed by their files.
+TREE = [
+    "main.py",
+    "build/out.o",
+    "src/build/keep.c",
+    "src/app.py",
+    "src/app.pyc",
+    "src/deep/er/app.pyc",
+    "docs/index.md",
+    "docs/api/ref.md",
+    "a/b.txt",
+    "a/x/y/b.txt",
+    "a/x/c.txt",
+    "cache",
+    "src/cache/data.bin",
+    "notes.txt",
+    "note.txt",
+    "notes/today.txt",
+    "file1.log",
+    "fileA.log",
+    "!important.txt",
+    "#hash.txt",
+    "venv/bin/python",
+    "log/24-01-01.log",
+    "src/__pycache__/app.cpython-311.pyc",
+    ".git/HEAD",
+    ".choco_cache/hashes.json",
+    "my.venv/keep.txt",
+]
+
+
+def excluded(patterns, defaults=False, paths=TREE):
+    matcher = ExcludeMatcher(patterns, defaults=defaults)
+    return sorted(path for path in paths if matcher.match(path))
+
+
+def test_name_matches_at_any_depth():
+    assert excluded(["build"]) == ["build/out.o", "src/build/keep.c"]
+    assert excluded(["app.pyc"]) == ["src/app.pyc", "src/deep/er/app.pyc"]
+
+
+def test_anchored():
+    assert excluded(["/build"]) == ["build/out.o"]
+    assert excluded(["/app.pyc"]) == []
+    # A pattern with a "/" in the middle is anchored too.
+    assert excluded(["src/build"]) == ["src/build/keep.c"]
+    assert excluded(["build/out.o"]) == ["build/out.o"]
+
+
+def test_directory_only():
+    assert excluded(["cache/"]) == ["src/cache/data.bin"]
+    assert excluded(["cache"]) == ["cache", "src/cache/data.bin"]
+    matcher = ExcludeMatcher(["cache/"], defaults=False)
+    assert matcher.match("cache", is_dir=True)
+    assert not matcher.match("cache")
+
+
+def test_star_does_not_cross_slash():
+    assert excluded(["*.pyc"]) == [
+        "src/__pycache__/app.cpython-311.pyc",
+        "src/app.pyc",
+        "src/deep/er/app.pyc",
+    ]
+    assert excluded(["src/*.pyc"]) == ["src/app.pyc"]
+    assert excluded(["a/*/b.txt"]) == []
+    assert excluded(["note?.txt"]) == ["notes.txt"]
+    assert excluded(["file[0-9].log"]) == ["file1.log"]
+    assert excluded(["file[!0-9].log"]) == ["fileA.log"]
+
+
+def test_double_star():
+    assert excluded(["a/**/b.txt"]) == ["a/b.txt", "a/x/y/b.txt"]
+    assert excluded(["**/api"]) == ["docs/api/ref.md"]
+    assert excluded(["docs/**"]) == ["docs/api/ref.md", "docs/index.md"]
+    assert excluded(["src/**/*.pyc"]) == [
+        "src/__pycache__/app.cpython-311.pyc",
+        "src/app.pyc",
+        "src/deep/er/app.pyc",
+    ]
+
+
+def test_negation_is_ignored():
+    assert translate("!notes.txt") is None
+    assert excluded(["notes*", "!notes.txt"]) == ["notes.txt", "notes/today.txt"]
+    # Escaped, "!" and "#" are part of the name.
+    assert excluded(["\\!important.txt"]) == ["!important.txt"]
+    assert excluded(["\\#hash.txt"]) == ["#hash.txt"]
+
+
+def test_comments_and_blanks():
+    assert translate("") is None
+    assert translate("   ") is None
+    assert translate("# build") is None
+    assert ExcludeMatcher([], defaults=False).pattern == "^$"
+    assert excluded(["./main.py"]) == ["main.py"]
+
+
+def test_special_characters_are_literal():
+    matcher = ExcludeMatcher(["a+b(1).txt", "x.y"], defaults=False)
+    assert matcher.match("a+b(1).txt")
+    assert matcher.match("x.y")
+    assert not matcher.match("xzy")
+
+
+def test_default_excludes():
+    assert DEFAULT_EXCLUDES == ["venv/", "log/", "__pycache__/", ".git/", ".choco_cache/"]
+    assert excluded([], defaults=True) == [
+        ".choco_cache/hashes.json",
+        ".git/HEAD",
+        "log/24-01-01.log",
+        "src/__pycache__/app.cpython-311.pyc",
+        "venv/bin/python",
+    ]
+    assert not ExcludeMatcher().match("my.venv/keep.txt")
+
+
+PATTERNS = [
+    [],
+    ["/build", "*.pyc"],
+    ["cache/", "docs/**", "note?.txt"],
+    ["a/**/b.txt", "src/*.pyc", "file[!0-9].log"],
+    ["\\!important.txt", "!notes.txt", "notes*"],
+]
+
+
+@pytest.fixture
+def project(tmp_path):
+    root = tmp_path / "project"
+    for path in TREE:
+        (root / path).parent.mkdir(parents=True, exist_ok=True)
+        (root / path).write_text(path)
+    return root
+
+
+def hashed(root, patterns, path=None):
+    """Files hash.sh reports for the project, with the given PATH."""
+    script = hashfind.replace("@EXCLUDE@", shlex.quote(ExcludeMatcher(patterns).pattern))
+    env = dict(os.environ, PATH=path or os.environ["PATH"])
+    out = subprocess.run(
+        ["bash", "-c", script], cwd=root, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return sorted(line.rpartition("=")[0] for line in out.splitlines())
+
+
+def walked(root, patterns):
+    """Files ExcludeMatcher keeps, without the manifest hash.sh leaves behind."""
+    paths = (
+        os.path.relpath(path, root).replace(os.sep, "/")
+        for path in ExcludeMatcher(patterns).files(str(root))
+    )
+    return sorted(path for path in paths if not path.startswith(".choco_manifest"))
+
+
+@pytest.mark.parametrize("patterns", PATTERNS)
+def test_python_hash_script_agrees(project, patterns):
+    hashed(project, patterns)  # The first run writes .choco_manifest.
+    assert hashed(project, patterns) == walked(project, patterns)
+
+
+@pytest.mark.parametrize("patterns", PATTERNS)
+def test_grep_fallback_agrees(project, patterns, tmp_path):
+    # A PATH without python3 makes hash.sh use find | grep -Ev.
+    tools = tmp_path / "bin"
+    tools.mkdir()
+    for tool in ("bash", "find", "sed", "grep", "sha256sum", "awk"):
+        found = shutil.which(tool)
+        if not found:
+            pytest.skip(f"{tool} is not installed")
+        os.symlink(found, tools / tool)
+    assert shutil.which("python3", path=str(tools)) is None
+    assert hashed(project, patterns, path=str(tools)) == walked(project, patterns)
+
+
+def test_walk_prunes_like_match(project):
+    patterns = ["cache/", "/build", "a/**/b.txt"]
+    matcher = ExcludeMatcher(patterns)
+    expected = sorted(path for path in TREE if not matcher.match(path))
+    assert walked(project, patterns) == expected
+    assert "src/cache/data.bin" not in expected
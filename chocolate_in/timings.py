@@ -0,0 +1,106 @@
+"""Phase timings, enabled with --timings or --trace.
+
+    with span("hash local") as counts:
+        ...
+        counts["files"] = len(files)
+
+Spans cost one dict when timings are off. When on, every finished span is
+recorded with its thread, so phases that run in parallel (uploads, several
+servers) show up side by side in the trace.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+_spans = None  # Finished spans while enabled, None when disabled.
+_origin = time.perf_counter_ns()
+
+
+def enable():
+    global _spans
+    if _spans is None:
+        _spans = []
+
+
+def enabled():
+    return _spans is not None
+
+
+@contextmanager
+def span(name, **counts):
+    """Time the block as phase name; counts (files, bytes, ...) may be set inside."""
+    if _spans is None:
+        yield counts
+        return
+    start = time.perf_counter_ns()
+    try:
+        yield counts
+    finally:
+        _spans.append(
+            {
+                "name": name,
+                "start": start - _origin,
+                "duration": time.perf_counter_ns() - start,
+                "thread": threading.get_ident(),
+                "counts": counts,
+            }
+        )
+
+
+def summary():
+    """Return {phase: {"calls", "seconds", counts...}} in order of first use."""
+    phases = {}
+    for entry in sorted(_spans or [], key=lambda entry: entry["start"]):
+        phase = phases.setdefault(entry["name"], {"calls": 0, "seconds": 0.0})
+        phase["calls"] += 1
+        phase["seconds"] += entry["duration"] / 1e9
+        for key, value in entry["counts"].items():
+            if isinstance(value, (int, float)):
+                phase[key] = phase.get(key, 0) + value
+    return phases
+
+
+def summary_table():
+    """A Rich table with the time, files and bytes of every phase."""
+    from rich.filesize import decimal
+    from rich.table import Table
+
+    table = Table(title="Timings")
+    table.add_column("Phase")
+    table.add_column("Calls", justify="right")
+    table.add_column("Seconds", justify="right")
+    table.add_column("Files", justify="right")
+    table.add_column("Bytes", justify="right")
+    for name, phase in summary().items():
+        table.add_row(
+            name,
+            str(phase["calls"]),
+            f"{phase['seconds']:.3f}",
+            str(phase["files"]) if "files" in phase else "",
+            decimal(phase["bytes"]) if "bytes" in phase else "",
+        )
+    return table
+
+
+def write_trace(path):
+    """Write the spans as a Chrome trace (chrome://tracing, Perfetto)."""
+    threads = {}
+    events = []
+    for entry in _spans or []:
+        tid = threads.setdefault(entry["thread"], len(threads))
+        events.append(
+            {
+                "name": entry["name"],
+                "ph": "X",
+                "ts": entry["start"] / 1000,
+                "dur": entry["duration"] / 1000,
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": entry["counts"],
+            }
+        )
+    with open(path, "w") as fp:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fp)
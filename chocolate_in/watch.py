@@ -0,0 +1,185 @@
+"""File change notifications for `chocolate sync --watch`.
+
+On Linux the tree is watched with inotify (through ctypes, no extra
+dependency); elsewhere, or when inotify is unavailable, the tree is polled.
+Both watchers return the relative paths of files that were written, created
+or moved into the project.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ATTRIB | IN_DELETE_SELF
+EVENT = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    def __init__(self, root, matcher):
+        name = ctypes.util.find_library("c")
+        if not name:
+            raise OSError("libc not found")
+        self.libc = ctypes.CDLL(name, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.root = root
+        self.matcher = matcher
+        self.dirs = {}
+        self.overflowed = False
+        for current, _ in matcher.walk(root):
+            self._add(current)
+
+    def _add(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            # Out of watches (fs.inotify.max_user_watches) or the folder is
+            # already gone; the next full sync will pick it up.
+            return False
+        self.dirs[wd] = path
+        return True
+
+    def _added_dir(self, path, changed):
+        # Files created before the new watch was in place produce no event.
+        for current, files in self.matcher.walk(path, self.root):
+            self._add(current)
+            for name in files:
+                changed.add(os.path.relpath(os.path.join(current, name), self.root))
+
+    def read(self, timeout):
+        """Return the paths changed within timeout seconds.
+
+        Returns None when the kernel queue overflowed and events were lost,
+        the caller should then fall back to a full sync.
+        """
+        changed = set()
+        deadline = time.monotonic() + timeout
+        # Events for excluded paths or new empty folders don't end the wait.
+        while not changed and not self.overflowed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([self.fd], [], [], remaining)[0]:
+                break
+            self._drain(changed)
+        if self.overflowed:
+            self.overflowed = False
+            return None
+        return changed
+
+    def _drain(self, changed):
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size : offset + EVENT.size + length].rstrip(b"\0")
+                offset += EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    self.overflowed = True
+                    continue
+                if mask & (IN_IGNORED | IN_DELETE_SELF):
+                    self.dirs.pop(wd, None)
+                    continue
+                parent = self.dirs.get(wd)
+                if parent is None or not name:
+                    continue
+                path = os.path.join(parent, os.fsdecode(name))
+                rel_path = os.path.relpath(path, self.root)
+                is_dir = bool(mask & IN_ISDIR)
+                if self.matcher.match(rel_path, is_dir):
+                    continue
+                if is_dir:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self._added_dir(path, changed)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_ATTRIB):
+                    changed.add(rel_path)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Compare (size, mtime) of every file every `interval` seconds."""
+
+    def __init__(self, root, matcher, interval=1.0):
+        self.root = root
+        self.matcher = matcher
+        self.interval = interval
+        self.state = self._scan()
+
+    def _scan(self):
+        state = {}
+        for current, files in self.matcher.walk(self.root):
+            for name in files:
+                path = os.path.join(current, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                state[os.path.relpath(path, self.root)] = (st.st_size, st.st_mtime_ns)
+        return state
+
+    def read(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        state = self._scan()
+        changed = {path for path, key in state.items() if self.state.get(path) != key}
+        self.state = state
+        return changed
+
+    def close(self):
+        pass
+
+
+def open_watcher(root, matcher):
+    """Return an inotify watcher when possible, a polling one otherwise.
+
+    matcher is an ignore.ExcludeMatcher, excluded paths are not watched.
+    """
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root, matcher)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(root, matcher)
+
+
+def batches(watcher, debounce=0.5, max_delay=5.0):
+    """Yield sets of changed paths, one per burst of changes.
+
+    A batch is closed once nothing changed for `debounce` seconds, or after
+    `max_delay` seconds of continuous changes. None is yielded when changes
+    may have been missed.
+    """
+    while True:
+        changed = watcher.read(3600)
+        if not changed and changed is not None:
+            continue
+        started = time.monotonic()
+        while changed is not None:
+            remaining = max_delay - (time.monotonic() - started)
+            if remaining <= 0:
+                break
+            more = watcher.read(min(debounce, remaining))
+            if more is None:
+                changed = None
+            elif more:
+                changed |= more
+            else:
+                break
+        yield changed